@@ -1,13 +1,35 @@
-from flask import Flask, request, render_template_string, redirect, url_for, session, jsonify, send_from_directory, abort, send_file
+from flask import Flask, request, render_template_string, redirect, url_for, session, jsonify, send_from_directory, abort, send_file, Response
 import os
 import random
 import subprocess
+import shutil
 import mimetypes
 import sqlite3
 from flask import g
 import hashlib
 import re
 import json
+import sys
+import time
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import base64
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote
+from werkzeug.utils import safe_join
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date, parse_date
+try:
+    import fcntl
+except ImportError:  # Windows: lock files fall back to O_EXCL creation
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'  # Replace with a secure secret key
@@ -26,11 +48,41 @@ USERS_DIR = os.path.join(BASE_DIR, 'users')
 
 DATABASE = os.path.join(BASE_DIR, 'appdata.sqlite3')
 
+# Columns added to tables after they were first created: (table, column definition)
+ADDED_COLUMNS = [
+    ('media', 'duration REAL'),
+    ('media', 'width INTEGER'),
+    ('media', 'height INTEGER'),
+    ('media', 'codec TEXT'),
+    ('media', 'probed_mtime REAL'),  # file mtime the metadata above was read at
+    ('media', 'probed_size INTEGER'),  # and file size
+    ('media', 'bitrate INTEGER'),  # bits per second, whole file
+    ('media', 'rotation INTEGER'),  # clockwise display rotation in degrees
+    ('media', 'derivatives TEXT'),  # widths of generated image derivatives, e.g. '320,640'
+    ('media', 'playable TEXT'),  # browser-playable rendition of a video, if one had to be made
+    ('media', 'stream TEXT'),  # HLS master playlist; '' once evicted from the cache
+    ('media', 'sprites TEXT'),  # WebVTT index of the video's scrub sprite sheet
+    ('media', 'preview TEXT'),  # short muted hover-preview clip
+    ('media', 'lqip TEXT'),  # tiny blurred placeholder (JPEG data URI) of the image or video thumbnail
+    ('media', 'content_hash TEXT'),  # SHA-256 of the file, keys its outputs in the derivative store
+    ('jobs', 'attempts INTEGER NOT NULL DEFAULT 0'),  # consecutive failures
+    ('jobs', 'source_mtime REAL'),  # source file mtime when the job was queued
+    ('jobs', 'next_retry REAL'),  # earliest time a failed job may run again
+    ('jobs', 'priority INTEGER NOT NULL DEFAULT 0'),  # higher runs first
+    ('catalog_state', 'store_layout INTEGER NOT NULL DEFAULT 0'),  # derivative store migrations applied
+    ('catalog_state', 'store_bytes INTEGER NOT NULL DEFAULT 0'),  # SUM(size) of derivative_store, kept by triggers
+]
+
+def connect_db():
+    """Open a new connection to the app database (usable outside a request)"""
+    db = sqlite3.connect(DATABASE, timeout=30)
+    db.row_factory = sqlite3.Row
+    return db
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        db = g._database = connect_db()
     return db
 
 @app.teardown_appcontext
@@ -66,7 +118,68 @@ def init_db():
             value INTEGER NOT NULL, -- 1 for like, -1 for dislike
             UNIQUE(media_key, user)
         );
+        CREATE TABLE IF NOT EXISTS media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT UNIQUE NOT NULL, -- relative to BASE_DIR, e.g. users/krishna/trip/day1/a.jpg
+            root TEXT NOT NULL, -- users, interfaith, gallery or videos
+            user TEXT NOT NULL,
+            tab TEXT NOT NULL,
+            album TEXT NOT NULL DEFAULT '', -- album path inside the tab, '' for the tab root
+            name TEXT NOT NULL,
+            type TEXT NOT NULL, -- image or video
+            size INTEGER,
+            mtime REAL,
+            thumb TEXT -- thumbnail path (in the derivative store) relative to BASE_DIR, if one exists
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_user_tab ON media(user, tab, album);
+        CREATE INDEX IF NOT EXISTS idx_media_root_type ON media(root, type);
+        -- Catalog-wide state in a single row (generation is no longer used)
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO catalog_state (id, generation) VALUES (1, 0);
+        DROP TRIGGER IF EXISTS media_generation_insert;
+        DROP TRIGGER IF EXISTS media_generation_delete;
+        CREATE TABLE IF NOT EXISTS tab_summary (
+            user TEXT NOT NULL,
+            tab TEXT NOT NULL,
+            tab_type TEXT NOT NULL,
+            media_count INTEGER NOT NULL DEFAULT 0,
+            image_count INTEGER NOT NULL DEFAULT 0,
+            video_count INTEGER NOT NULL DEFAULT 0,
+            album_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user, tab)
+        );
+        CREATE TABLE IF NOT EXISTS album_covers (
+            dir TEXT PRIMARY KEY, -- album directory relative to BASE_DIR
+            cover TEXT, -- image or video thumbnail path relative to BASE_DIR, NULL if the album has no media
+            override TEXT -- media path chosen by the user, if any
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL, -- e.g. thumbnail
+            path TEXT NOT NULL, -- source media path relative to BASE_DIR
+            status TEXT NOT NULL DEFAULT 'queued', -- queued, running, done or failed
+            error TEXT,
+            created REAL,
+            started REAL,
+            finished REAL,
+            UNIQUE(kind, path)
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id);
+        -- Outputs in the derivative store, one row per (content, variant), for LRU eviction
+        CREATE TABLE IF NOT EXISTS derivative_store (
+            content_hash TEXT NOT NULL,
+            variant TEXT NOT NULL, -- e.g. thumb, w320, playable, hls
+            size INTEGER NOT NULL, -- bytes on disk, all formats of the variant together
+            last_used REAL NOT NULL,
+            PRIMARY KEY (content_hash, variant)
+        );
+        CREATE INDEX IF NOT EXISTS idx_derivative_store_lru ON derivative_store(last_used);
         ''')
+        db.execute('PRAGMA journal_mode=WAL')
         
         # Add avatar_seed column to existing users table if it doesn't exist
         try:
@@ -78,9 +191,32 @@ def init_db():
             else:
                 print(f"Error adding avatar_seed column: {e}")
         
+        for table, column in ADDED_COLUMNS:
+            try:
+                db.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+            except sqlite3.OperationalError as e:
+                if "duplicate column name" not in str(e):
+                    print(f"Error adding {table} column {column}: {e}")
+        # Video index: every video in the catalog, in id order per root
+        db.execute("CREATE INDEX IF NOT EXISTS idx_media_videos ON media(root, id) WHERE type = 'video'")
+        db.execute('CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, priority DESC, id)')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_media_content_hash ON media(content_hash)')
+        # Store size as a running total, so checking the cap does not sum the whole table
+        db.execute("""CREATE TRIGGER IF NOT EXISTS derivative_store_insert AFTER INSERT ON derivative_store
+                      BEGIN UPDATE catalog_state SET store_bytes = store_bytes + NEW.size WHERE id = 1; END""")
+        db.execute("""CREATE TRIGGER IF NOT EXISTS derivative_store_update AFTER UPDATE OF size ON derivative_store
+                      BEGIN UPDATE catalog_state SET store_bytes = store_bytes + NEW.size - OLD.size WHERE id = 1; END""")
+        db.execute("""CREATE TRIGGER IF NOT EXISTS derivative_store_delete AFTER DELETE ON derivative_store
+                      BEGIN UPDATE catalog_state SET store_bytes = store_bytes - OLD.size WHERE id = 1; END""")
+        # Counted once per start: fills the column on upgrade and corrects any drift
+        db.execute('UPDATE catalog_state SET store_bytes = (SELECT COALESCE(SUM(size), 0) FROM derivative_store)')
+        
         db.commit()
         # Create default user for backward compatibility
         create_default_user()
+        # Move outputs of older layouts out of the way before anything is catalogued
+        migrate_derivative_store(db)
+        # An empty catalog is built by the background leader (start_initial_reconcile)
 
 def hash_password(password):
     """Hash a password using SHA-256"""
@@ -169,39 +305,167 @@ def create_default_user():
 # Remove @app.before_first_request and use a flag with @app.before_request
 _db_initialized = False
 
+# Background work (catalog watcher, video indexer, job workers) runs in one
+# process only. Under a multi-process server (gunicorn -w 4) the first process
+# to take an flock on LOCK_DIR/background.lock keeps it for its lifetime and
+# starts the threads; the others just serve requests, and their enqueued jobs
+# are picked up by the leader's workers when they next poll. If the leader
+# exits, another process takes over on a later request.
+LEADER_RETRY_INTERVAL = 30
+_run_background = True  # off for one-shot commands such as bench-files
+_leader_lock_fd = None
+_leader_checked = 0.0
+
+def _claim_background_leader():
+    """True if this process runs the background threads (taking the leader lock if it is free)."""
+    global _leader_lock_fd, _leader_checked
+    if _leader_lock_fd is not None:
+        return True
+    if fcntl is None:
+        return True  # no flock (Windows): no multi-process servers either
+    if time.time() - _leader_checked < LEADER_RETRY_INTERVAL:
+        return False
+    _leader_checked = time.time()
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    fd = os.open(os.path.join(LOCK_DIR, 'background.lock'), os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _leader_lock_fd = fd  # held until the process exits
+    print(f"Process {os.getpid()} runs the background workers")
+    return True
+
 @app.before_request
 def before_request():
     global _db_initialized
     if not _db_initialized:
         init_db()
         _db_initialized = True
+    if _run_background and _leader_lock_fd is None and _claim_background_leader():
+        start_initial_reconcile()
+        start_catalog_watcher()
+        start_video_indexer()
+        start_job_workers()
+
+# --- Media walker ---
+# One record per directory entry. `kind` is 'dir', 'image', 'video' or 'file';
+# `rel_path` is relative to BASE_DIR with forward slashes; `entry` is the
+# os.DirEntry, so entry.stat() is only paid for (and cached) when needed.
+MediaEntry = namedtuple('MediaEntry', 'kind name path rel_path entry')
+
+def walk_media(top, recursive=True):
+    """
+    Iteratively walk `top` with os.scandir, yielding MediaEntry records.
+    A directory's record is yielded before anything inside it. Unreadable
+    directories are skipped. As with os.walk, symlinked directories are listed
+    but not descended into, so a link loop cannot make the walk recurse.
+    """
+    stack = [top]
+    while stack:
+        current = stack.pop()
+        rel_dir = os.path.relpath(current, BASE_DIR).replace('\\', '/')
+        try:
+            scanner = os.scandir(current)
+        except OSError:
+            continue
+        subdirs = []
+        with scanner:
+            for entry in scanner:
+                name = entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    kind = 'dir'
+                    if recursive and not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif is_image(name):
+                    kind = 'image'
+                elif is_video(name):
+                    kind = 'video'
+                else:
+                    kind = 'file'
+                yield MediaEntry(kind, name, entry.path, rel_dir + '/' + name, entry)
+        stack.extend(reversed(subdirs))
+
+# --- Parallel scanner ---
+# On network-mounted media volumes per-directory latency dominates, so large
+# scans list directories concurrently: each directory is one task on a bounded
+# thread pool, with at most SCAN_PER_ROOT_LIMIT tasks in flight per root.
+SCAN_MAX_WORKERS = int(os.environ.get('SCAN_MAX_WORKERS', 8))
+SCAN_PER_ROOT_LIMIT = int(os.environ.get('SCAN_PER_ROOT_LIMIT', 4))
+
+def _scan_one_dir(path, with_stat):
+    records = list(walk_media(path, recursive=False))
+    if with_stat:
+        # Warm the DirEntry stat cache on the worker thread
+        for record in records:
+            if record.kind != 'dir':
+                try:
+                    record.entry.stat()
+                except OSError:
+                    pass
+    return records
+
+def parallel_walk_media(roots, with_stat=False, max_workers=None, per_root_limit=None):
+    """
+    Walk several roots concurrently, streaming MediaEntry records as directory
+    listings complete. `roots` is a list of paths or (path, recursive) pairs.
+    As with walk_media, a directory's record always comes before its contents,
+    but the order across directories is not fixed.
+    """
+    max_workers = max_workers or SCAN_MAX_WORKERS
+    per_root_limit = per_root_limit or SCAN_PER_ROOT_LIMIT
+    pending = {}  # root index -> directories still to list
+    recursive_of = {}
+    for index, root in enumerate(roots):
+        path, recursive = root if isinstance(root, tuple) else (root, True)
+        if os.path.isdir(path):
+            pending[index] = [path]
+            recursive_of[index] = recursive
+    in_flight = {index: 0 for index in pending}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scan') as pool:
+        futures = {}
+        while True:
+            for index, dirs in pending.items():
+                while dirs and in_flight[index] < per_root_limit:
+                    futures[pool.submit(_scan_one_dir, dirs.pop(), with_stat)] = index
+                    in_flight[index] += 1
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                in_flight[index] -= 1
+                for record in future.result():
+                    if record.kind == 'dir' and recursive_of[index] and not record.entry.is_symlink():
+                        pending[index].append(record.path)
+                    yield record
 
 def list_users():
-    return [d for d in os.listdir(USERS_DIR) if os.path.isdir(os.path.join(USERS_DIR, d))]
+    return [e.name for e in walk_media(USERS_DIR, recursive=False) if e.kind == 'dir']
 
 def list_tabs(username):
     user_dir = os.path.join(USERS_DIR, username)
     if not os.path.exists(user_dir):
         return []
-    return [d for d in os.listdir(user_dir) if os.path.isdir(os.path.join(user_dir, d))]
+    return [e.name for e in walk_media(user_dir, recursive=False) if e.kind == 'dir']
 
 def detect_tab_type(tab_path):
-    # Recursively scan the tab directory to determine type
+    # Scan the top level of the tab directory to determine type
     has_image = False
     has_video = False
     has_folder = False
     
-    for entry in os.listdir(tab_path):
-        # Skip thumbnail files as they don't affect the tab type
-        if entry.endswith('_thumb.jpg'):
-            continue
-            
-        full_path = os.path.join(tab_path, entry)
-        if os.path.isdir(full_path):
+    for entry in walk_media(tab_path, recursive=False):
+        if entry.kind == 'dir':
             has_folder = True
-        elif is_image(entry):
+        elif entry.kind == 'image':
             has_image = True
-        elif is_video(entry):
+        elif entry.kind == 'video':
             has_video = True
     if has_folder:
         return 'albums'
@@ -213,77 +477,80 @@ def detect_tab_type(tab_path):
         return 'mixed'
     return 'empty'
 
-def get_tab_media(username, tab, rel_path=None):
-    # rel_path is used for recursion (subfolders)
-    if rel_path is None:
-        tab_path = os.path.join(USERS_DIR, username, tab)
-        rel_path = tab
-    else:
-        tab_path = os.path.join(USERS_DIR, username, rel_path)
-    items = []
-    for entry in os.listdir(tab_path):
-        full_path = os.path.join(tab_path, entry)
-        rel_entry = os.path.join(rel_path, entry).replace('\\', '/')
-        if os.path.isdir(full_path):
-            # Recursively get children for albums
-            children = get_tab_media(username, tab, rel_entry)
-            items.append({'type': 'album', 'name': entry, 'children': children})
-        elif is_image(entry):
-            url = url_for('files', filename=os.path.join('users', username, rel_entry).replace('\\', '/'))
-            items.append({'type': 'image', 'name': entry, 'url': url})
-        elif is_video(entry):
-            url = url_for('files', filename=os.path.join('users', username, rel_entry).replace('\\', '/'))
-            thumb = get_video_thumbnail_local(os.path.join('users', username, rel_entry).replace('\\', '/'))
-            items.append({'type': 'video', 'name': entry, 'url': url, 'thumb': thumb})
-    return items
-
 # --- Paginated, non-recursive tab media ---
-def get_tab_media_paged(username, tab, rel_path=None, offset=0, limit=30):
+# Directory listings are memoized as compact manifests keyed by (user, tab,
+# rel_path) and validated against the directory's inode and mtime, so paging
+# through a tab or album slices the manifest instead of re-listing the folder.
+MANIFEST_CACHE_SIZE = 256
+_manifest_cache = OrderedDict()
+_manifest_lock = threading.Lock()
+
+def get_dir_manifest(username, tab, rel_path=None):
+    """
+    Return a tuple of (type, name, local_path) entries for a tab directory,
+    rebuilt only when the directory has changed. Raises OSError if it is missing.
+    """
     if rel_path is None:
         tab_path = os.path.join(USERS_DIR, username, tab)
     else:
         tab_path = os.path.join(USERS_DIR, username, tab, rel_path)
+    st = os.stat(tab_path)
+    key = (username, tab, rel_path or '')
+    stamp = (st.st_ino, st.st_mtime_ns)
+    with _manifest_lock:
+        cached = _manifest_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            _manifest_cache.move_to_end(key)
+            return cached[1]
+    entries = []
+    for entry in walk_media(tab_path, recursive=False):
+        if entry.kind == 'dir':
+            entries.append(('album', entry.name, entry.rel_path))
+        elif entry.kind in ('image', 'video'):
+            entries.append((entry.kind, entry.name, entry.rel_path))
+    manifest = tuple(entries)
+    with _manifest_lock:
+        _manifest_cache[key] = (stamp, manifest)
+        _manifest_cache.move_to_end(key)
+        while len(_manifest_cache) > MANIFEST_CACHE_SIZE:
+            _manifest_cache.popitem(last=False)
+    return manifest
+
+def get_tab_media_paged(username, tab, rel_path=None, offset=0, limit=30, seed=None):
     try:
-        entries = os.listdir(tab_path)
-        # Don't sort - keep the natural order from the filesystem
-        print(f"Raw entries in {tab_path}: {entries}")
-    except Exception as e:
+        manifest = get_dir_manifest(username, tab, rel_path)
+    except OSError:
         return []
-    
+    # Shuffle to mix images and videos; a fixed seed keeps pages consistent across offsets
+    if seed is None:
+        seed = random.getrandbits(63)
+    n = len(manifest)
+    page = [manifest[permute_index(i, n, seed)] for i in range(offset, min(offset + limit, n))]
+    rows = catalog_rows(get_db(), [entry[2] for entry in page if entry[0] != 'album'])
     items = []
-    for entry in entries:
-        if entry.endswith('_thumb.jpg'):
-            continue
-        full_path = os.path.join(tab_path, entry)
-        if rel_path is None:
-            rel_entry = os.path.join(tab, entry).replace('\\', '/')
+    for media_type, name, local_path in page:
+        if media_type == 'album':
+            items.append({'type': 'album', 'name': name, 'album_thumb': album_cover_url(get_db(), local_path)})
+        elif media_type == 'image':
+            items.append({'type': 'image', 'name': name, 'url': url_for('files', filename=local_path),
+                          'srcset': image_srcset(rows.get(local_path)), **media_metadata(rows.get(local_path))})
         else:
-            rel_entry = os.path.join(tab, rel_path, entry).replace('\\', '/')
-        
-        if os.path.isdir(full_path):
-            items.append({'type': 'album', 'name': entry})
-            print(f"Added album: {entry}")
-        elif is_image(entry):
-            url = url_for('files', filename=os.path.join('users', username, rel_entry).replace('\\', '/'))
-            items.append({'type': 'image', 'name': entry, 'url': url})
-            print(f"Added image: {entry}")
-        elif is_video(entry):
-            url = url_for('files', filename=os.path.join('users', username, rel_entry).replace('\\', '/'))
-            thumb = get_video_thumbnail_local(os.path.join('users', username, rel_entry).replace('\\', '/'))
-            items.append({'type': 'video', 'name': entry, 'url': url, 'thumb': thumb})
-            print(f"Added video: {entry}")
-    
-    print(f"Final items order: {[item['type'] + ':' + item['name'] for item in items]}")
-    
-    # Shuffle the items to ensure random mixing of images and videos
-    import random
-    random.shuffle(items)
-    print(f"After shuffle: {[item['type'] + ':' + item['name'] for item in items]}")
-    
-    items = items[offset:offset+limit]
-    print(f"Returning {len(items)} items for {tab_path} (offset={offset}, limit={limit})")
+            thumb = get_video_thumbnail_local(local_path, rows.get(local_path))
+            items.append({'type': 'video', 'name': name, 'url': url_for('files', filename=local_path), 'thumb': thumb,
+                          **video_derivative_urls(rows.get(local_path)), **media_metadata(rows.get(local_path))})
+    print(f"Returning {len(items)} items for {username}/{tab}/{rel_path or ''} (offset={offset}, limit={limit})")
     return items
 
+def media_shuffle_seed():
+    """Per-client shuffle seed for tab/album pages (a valid ?seed= argument overrides it)."""
+    seed = request.args.get('seed', type=int)
+    # permute_index keys on 8 bytes of seed; a bad one falls back to the session's
+    if seed is not None and 0 <= seed < 2 ** 64:
+        return seed
+    if 'media_seed' not in session:
+        session['media_seed'] = random.getrandbits(63)
+    return session['media_seed']
+
 # --- Helper functions ---
 def is_video(filename):
     return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
@@ -291,248 +558,2133 @@ def is_video(filename):
 def is_image(filename):
     return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
 
-def get_video_thumbnail_local(local_path):
+DEFAULT_VIDEO_THUMB = 'default_video_thumb.png'
+
+THUMB_JOB_TIMEOUT = int(os.environ.get('THUMB_JOB_TIMEOUT', 120))
+
+# --- Derivative store ---
+# Everything made from a media file (thumbnails, downscaled images, renditions,
+# sprites, previews) lives outside the media folders in a content-addressed
+# store, .derivatives/<h[:2]>/<h[2:4]>/<h>/<variant>.<ext> where h is the
+# SHA-256 of the source, so identical files share their outputs and renames
+# keep them. Each (hash, variant) is accounted in the derivative_store table;
+# past DERIVATIVE_STORE_MAX_BYTES the least recently served variants are
+# evicted and their catalog references cleared, to be remade when next wanted.
+DERIVATIVE_DIR = os.path.join(BASE_DIR, '.derivatives')
+DERIVATIVE_STORE_MAX_BYTES = int(os.environ.get('DERIVATIVE_STORE_MAX_BYTES', 50 * 1024 ** 3))
+STORE_TOUCH_INTERVAL = 3600  # how often serving a variant refreshes its last-used time
+STORE_LAYOUT = 1  # bumped when migrate_derivative_store has a new step
+HASH_CHUNK_SIZE = 1024 * 1024
+_STORE_PATH_RE = re.compile(r'\.derivatives/([0-9a-f]{2})/([0-9a-f]{2})/([0-9a-f]{64})/([^/.]+)')
+# Catalog column pointing at each variant; image widths (w320, ...) are listed in `derivatives`
+STORE_VARIANT_COLUMNS = {'thumb': 'thumb', 'playable': 'playable', 'hls': 'stream',
+                         'sprites': 'sprites', 'preview': 'preview'}
+_store_touched = {}
+
+def derivative_path_for(content_hash, variant, ext=None):
+    """Path (relative to BASE_DIR) of an output in the store; without `ext`, a directory."""
+    name = variant if ext is None else f'{variant}.{ext}'
+    return f'.derivatives/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}/{name}'
+
+def thumb_path_for(content_hash):
+    """Thumbnail path (relative to BASE_DIR) for a video with this content hash."""
+    return derivative_path_for(content_hash, 'thumb', 'jpg')
+
+def parse_store_path(rel_path):
+    """(content_hash, variant) for a path inside the derivative store, or None."""
+    match = _STORE_PATH_RE.match(rel_path)
+    if match is None or not match.group(3).startswith(match.group(1) + match.group(2)):
+        return None
+    return match.group(3), match.group(4)
+
+def hash_media_file(full_path):
+    """
+    SHA-256 of a file and the stat it describes. Raises RuntimeError if the file
+    changed while it was being read.
+    """
+    before = os.stat(full_path)
+    digest = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    after = os.stat(full_path)
+    if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns):
+        raise RuntimeError('file changed while it was being hashed')
+    return digest.hexdigest(), after
+
+def store_content_hash(db, path, st, content_hash):
+    # Only onto the row for this version of the file; a newer version clears it anyway
+    db.execute('UPDATE media SET content_hash = ? WHERE path = ? AND size = ? AND mtime = ?',
+               (content_hash, path, st.st_size, st.st_mtime))
+
+def content_hash_for(db, path):
+    """
+    (content hash, stat) for a media file, hashing it only if it changed since
+    its hash was catalogued. Generators take this pair as `source`, so output
+    made while the file changes under them is thrown away. A new hash is
+    committed at once: callers run ffmpeg next and must not hold the write lock.
+    """
+    full_path = os.path.join(BASE_DIR, path)
+    st = os.stat(full_path)
+    row = db.execute('SELECT content_hash, size, mtime FROM media WHERE path = ?', (path,)).fetchone()
+    if row is not None and row['content_hash'] and (row['size'], row['mtime']) == (st.st_size, st.st_mtime):
+        return row['content_hash'], st
+    content_hash, st = hash_media_file(full_path)
+    store_content_hash(db, path, st, content_hash)
+    db.commit()
+    return content_hash, st
+
+def _dir_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+def _variant_files(content_hash, variant):
+    """Full paths of a variant's outputs: <variant> and <variant>.<ext> in its hash directory."""
+    full_dir = os.path.dirname(os.path.join(BASE_DIR, derivative_path_for(content_hash, variant)))
+    try:
+        names = os.listdir(full_dir)
+    except OSError:
+        return []
+    return [os.path.join(full_dir, name) for name in names
+            if name == variant or (name.startswith(variant + '.') and not name.endswith('.part'))]
+
+def record_derivative(db, rel_path):
+    """
+    Account for an output just written to the store, then evict least recently
+    used variants if the store is over its cap. The caller commits.
+    """
+    parsed = parse_store_path(rel_path)
+    if parsed is None:
+        return
+    size = 0
+    files = _variant_files(*parsed)
+    for full_path in files:
+        try:
+            size += _dir_size(full_path) if os.path.isdir(full_path) else os.path.getsize(full_path)
+        except OSError:
+            pass
+    if not files:
+        return  # thrown away because the source changed
+    db.execute("""INSERT INTO derivative_store (content_hash, variant, size, last_used) VALUES (?, ?, ?, ?)
+                  ON CONFLICT(content_hash, variant) DO UPDATE SET size = excluded.size,
+                                                                  last_used = excluded.last_used""",
+               (*parsed, size, time.time()))
+    evict_derivatives(db)
+
+def _forget_variant(db, content_hash, variant):
+    """Clear catalog references to an evicted variant so it is made again when wanted."""
+    column = STORE_VARIANT_COLUMNS.get(variant)
+    if column is None and re.fullmatch(r'w\d+', variant):
+        column = 'derivatives'
+    if column == 'thumb':
+        db.execute('DELETE FROM album_covers WHERE override IS NULL AND cover = ?', (thumb_path_for(content_hash),))
+    if column == 'stream':
+        # Evicted renditions are marked '' so they are not packaged again straight away
+        db.execute("UPDATE media SET stream = '' WHERE content_hash = ?", (content_hash,))
+    elif column is not None:
+        db.execute(f'UPDATE media SET {column} = NULL WHERE content_hash = ?', (content_hash,))
+
+def evict_derivatives(db):
+    """Remove the least recently used variants until the store fits DERIVATIVE_STORE_MAX_BYTES. The caller commits."""
+    total = db.execute('SELECT store_bytes FROM catalog_state WHERE id = 1').fetchone()[0]
+    while total > DERIVATIVE_STORE_MAX_BYTES:
+        rows = db.execute('SELECT content_hash, variant, size FROM derivative_store '
+                          'ORDER BY last_used LIMIT 100').fetchall()
+        if not rows:
+            break
+        for row in rows:
+            if total <= DERIVATIVE_STORE_MAX_BYTES:
+                break
+            print(f"Evicting {row['variant']} of {row['content_hash']} ({row['size']} bytes)")
+            for full_path in _variant_files(row['content_hash'], row['variant']):
+                if os.path.isdir(full_path):
+                    shutil.rmtree(full_path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(full_path)
+                    except OSError:
+                        pass
+            db.execute('DELETE FROM derivative_store WHERE content_hash = ? AND variant = ?',
+                       (row['content_hash'], row['variant']))
+            _forget_variant(db, row['content_hash'], row['variant'])
+            total -= row['size']
+    prune_lock_files()
+
+def touch_derivative(rel_path):
+    """Count a request for a store file as use of its variant (written at most every STORE_TOUCH_INTERVAL)."""
+    parsed = parse_store_path(rel_path)
+    if parsed is None:
+        return
+    now = time.time()
+    if now - _store_touched.get(parsed, 0) < STORE_TOUCH_INTERVAL:
+        return
+    if len(_store_touched) > 100000:
+        _store_touched.clear()
+    _store_touched[parsed] = now
+    db = get_db()
+    db.execute('UPDATE derivative_store SET last_used = ? WHERE content_hash = ? AND variant = ?', (now, *parsed))
+    db.commit()
+
+def legacy_thumb_path_for(local_path):
+    """Where migrate_derivative_store parked a video's old `<name>_thumb.jpg` sidecar."""
+    return f".derivatives/legacy-thumbs/{local_path.replace(os.sep, '/')}.jpg"
+
+def migrate_derivative_store(db):
+    """
+    Move to the content-addressed store, once. Outputs of the old path-keyed
+    layout are dropped and queued again; `<name>_thumb.jpg` sidecars next to
+    videos are parked under .derivatives/legacy-thumbs, still serving as the
+    thumbnail, until the thumbnail job files them under the video's hash.
+    """
+    if db.execute('SELECT store_layout FROM catalog_state WHERE id = 1').fetchone()[0] >= STORE_LAYOUT:
+        return
+    print("Migrating thumbnails and derivatives to the content-addressed store...")
+    if os.path.isdir(DERIVATIVE_DIR):
+        for name in os.listdir(DERIVATIVE_DIR):
+            if not re.fullmatch(r'[0-9a-f]{2}', name):
+                shutil.rmtree(os.path.join(DERIVATIVE_DIR, name), ignore_errors=True)
+    db.execute('''UPDATE media SET thumb = NULL, derivatives = NULL, playable = NULL, sprites = NULL,
+                  preview = NULL, stream = CASE WHEN stream = '' THEN '' END''')
+    db.execute('DELETE FROM album_covers WHERE override IS NULL')
+    parked = []
+    for root_name, root_dir in MEDIA_ROOTS:
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            videos = {os.path.splitext(name)[0]: name for name in filenames if is_video(name)}
+            for name in filenames:
+                video = videos.get(name[:-len('_thumb.jpg')]) if name.endswith('_thumb.jpg') else None
+                if video is None:
+                    continue  # not a sidecar (maybe a user's own image)
+                local_path = os.path.relpath(os.path.join(dirpath, video), BASE_DIR).replace(os.sep, '/')
+                thumb = legacy_thumb_path_for(local_path)
+                os.makedirs(os.path.dirname(os.path.join(BASE_DIR, thumb)), exist_ok=True)
+                os.replace(os.path.join(dirpath, name), os.path.join(BASE_DIR, thumb))
+                db.execute('UPDATE media SET thumb = ? WHERE path = ?', (thumb, local_path))
+                parked.append(local_path)
+    for local_path in parked:
+        enqueue_job(db, 'thumbnail', local_path)
+    queue_missing_derivatives(db)
+    db.execute('UPDATE catalog_state SET store_layout = ? WHERE id = 1', (STORE_LAYOUT,))
+    db.commit()
+    print(f"migrate_derivative_store: {len(parked)} thumbnail sidecars moved out of the media folders")
+
+# --- Single-flight locks ---
+# Only one extraction may run per output file: an in-process lock serialises
+# threads, and a lock file under LOCK_DIR (flock, or O_EXCL where flock is not
+# available) serialises worker processes. flock'd lock files outlive their
+# lock, so prune_lock_files clears out idle ones now and then.
+LOCK_DIR = os.path.join(BASE_DIR, '.locks')
+LOCK_STALE_SECONDS = 600
+_flight_locks = {}
+_flight_guard = threading.Lock()
+_locks_pruned = 0.0
+
+def _flock_lock_file(lock_path, wait):
+    """flock `lock_path` and return its fd, or None if it is held and wait is False."""
+    while True:
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)  # pruned while we waited for it; lock the file now at that path
+
+def prune_lock_files():
+    """
+    Remove flock lock files older than LOCK_STALE_SECONDS that nobody holds, at
+    most once per LOCK_STALE_SECONDS. (O_EXCL lock files are removed on release.)
     """
-    Given a local file path relative to BASE_DIR (e.g., "interfaith/myvideo.mp4"),
-    check if a thumbnail with suffix "_thumb.jpg" exists. If not, generate one using ffmpeg.
-    Return the thumbnail URL or a default if generation fails.
+    global _locks_pruned
+    if fcntl is None or time.time() - _locks_pruned < LOCK_STALE_SECONDS:
+        return
+    _locks_pruned = time.time()
+    try:
+        names = os.listdir(LOCK_DIR)
+    except OSError:
+        return
+    cutoff = time.time() - LOCK_STALE_SECONDS
+    for name in names:
+        if not name.endswith('.lock') or name == 'background.lock':
+            continue
+        lock_path = os.path.join(LOCK_DIR, name)
+        try:
+            if os.path.getmtime(lock_path) > cutoff:
+                continue
+            fd = os.open(lock_path, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            # Removed while held, so anyone waiting on it sees it is gone and starts over
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(lock_path)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def _acquire_lock_file(lock_path, wait):
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_STALE_SECONDS:
+                    os.remove(lock_path)  # left behind by a crashed process
+                    continue
+            except OSError:
+                continue
+            if not wait:
+                return False
+            time.sleep(0.1)
+
+@contextmanager
+def single_flight(key, wait=True):
     """
-    base, ext = os.path.splitext(local_path)
-    thumb_path = base + "_thumb.jpg"
+    Hold the lock for `key` across threads and processes. Yields True once held;
+    with wait=False yields False straight away if another caller holds it.
+    """
+    with _flight_guard:
+        entry = _flight_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        if not entry[0].acquire(blocking=wait):
+            yield False
+            return
+        try:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            lock_path = os.path.join(LOCK_DIR, hashlib.sha1(key.encode()).hexdigest() + '.lock')
+            if fcntl is not None:
+                fd = _flock_lock_file(lock_path, wait)
+                if fd is None:
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    os.close(fd)  # releases the flock
+            else:
+                acquired = _acquire_lock_file(lock_path, wait)
+                try:
+                    yield acquired
+                finally:
+                    if acquired:
+                        os.remove(lock_path)
+        finally:
+            entry[0].release()
+    finally:
+        with _flight_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _flight_locks[key]
+
+def ffmpeg_to_file(input_args, output_args, full_output_path, timeout=None, guard=None):
+    """
+    Run ffmpeg writing to a hidden temp file next to `full_output_path`, then
+    rename it into place. `output_args` must name the format (-f) since the temp
+    file has no usable extension. Raises like subprocess.run, or RuntimeError if
+    ffmpeg wrote nothing. `guard` is an optional (path, stat) pair: if that file
+    changed while ffmpeg ran, the output is thrown away and False is returned.
+    Callers hold the output's single_flight lock.
+    """
+    os.makedirs(os.path.dirname(full_output_path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(full_output_path),
+                            f'.{os.path.basename(full_output_path)}.{os.getpid()}.part')
+    try:
+        subprocess.run(['ffmpeg', '-y', *input_args, *output_args, tmp_path],
+                       check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        # ffmpeg can exit cleanly without writing anything (e.g. seeking past the end)
+        if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) == 0:
+            raise RuntimeError('ffmpeg produced no output')
+        if guard is not None:
+            st = os.stat(guard[0])
+            if (st.st_size, st.st_mtime_ns) != (guard[1].st_size, guard[1].st_mtime_ns):
+                return False
+        os.replace(tmp_path, full_output_path)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+THUMB_POSITION = 0.1  # fraction of the duration the thumbnail frame is taken at
+
+def extract_video_thumbnail(local_path, source, timeout=None, duration=None):
+    """
+    Run ffmpeg to write the thumbnail for a video path relative to BASE_DIR into
+    the store; `source` is its (content hash, stat) from content_hash_for.
+    The frame is taken THUMB_POSITION into the clip (`duration` is probed if not
+    given), or at 1s if the duration can't be read.
+    Returns the thumbnail path; raises CalledProcessError, TimeoutExpired or
+    FileNotFoundError (no ffmpeg) on failure. Concurrent calls for the same
+    content wait for the first one, and the JPEG is written to a temp file and
+    renamed into place so readers never see a partial file.
+    """
+    thumb_path = thumb_path_for(source[0])
     full_thumb_path = os.path.join(BASE_DIR, thumb_path)
-    if not os.path.exists(full_thumb_path):
-        # Generate thumbnail using ffmpeg
-        print(f"Generating thumbnail for {local_path}...")
-        video_full_path = os.path.join(BASE_DIR, local_path)
+    full_path = os.path.join(BASE_DIR, local_path)
+    with single_flight(thumb_path):
+        if os.path.exists(full_thumb_path):
+            return thumb_path  # made by whoever held the lock before us, or for an identical file
+        if duration is None:
+            duration = probe_video(full_path).get('duration')
+        position = duration * THUMB_POSITION if duration else 1.0
+        print(f"Generating thumbnail for {local_path} at {position:.1f}s...")
+        ffmpeg_to_file(
+            ['-ss', f'{position:.3f}', '-i', full_path],  # seek on input: no decoding up to the frame
+            ['-vframes', '1', '-f', 'image2', '-c:v', 'mjpeg'],
+            full_thumb_path, timeout, guard=(full_path, source[1]))
+    print(f"Thumbnail generated: {thumb_path}")
+    return thumb_path
+
+# --- Image derivatives ---
+# Downscaled copies of uploaded images live in the derivative store as
+# w<width>.jpg, served through /files. Each image gets one JPEG per
+# DERIVATIVE_WIDTHS entry narrower than itself; the widths made are recorded in
+# the catalog so payloads can offer a srcset.
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+# Formats ffmpeg can't rasterise (or that gain nothing from downscaling)
+NO_DERIVATIVE_EXTENSIONS = {'.svg', '.ico'}
+
+def can_derive_image(local_path):
+    return is_image(local_path) and os.path.splitext(local_path)[1].lower() not in NO_DERIVATIVE_EXTENSIONS
+
+def generate_image_derivative(local_path, source, width, timeout=None):
+    """
+    Write a JPEG of the image scaled down to `width` pixels into the store,
+    unless it is there already, and return its path relative to BASE_DIR.
+    """
+    derivative_path = derivative_path_for(source[0], f'w{width}', 'jpg')
+    full_derivative_path = os.path.join(BASE_DIR, derivative_path)
+    full_source_path = os.path.join(BASE_DIR, local_path)
+    with single_flight(derivative_path):
+        if not os.path.exists(full_derivative_path):
+            ffmpeg_to_file(
+                ['-i', full_source_path],
+                ['-vf', f'scale={width}:-2', '-frames:v', '1',
+                 '-f', 'image2', '-c:v', 'mjpeg', '-q:v', '4'],
+                full_derivative_path, timeout, guard=(full_source_path, source[1]))
+    return derivative_path
+
+# Low-quality image placeholders: a LQIP_WIDTH-pixel JPEG, inlined as a data URI
+# in payloads so clients can paint a blurred preview before the real image loads.
+LQIP_WIDTH = 16
+
+def make_lqip(full_path, timeout=None):
+    """Tiny JPEG of an image as a data: URI."""
+    result = subprocess.run([
+        'ffmpeg', '-v', 'error', '-i', full_path,
+        '-vf', f'scale={LQIP_WIDTH}:-2', '-frames:v', '1',
+        '-f', 'image2pipe', '-c:v', 'mjpeg', '-q:v', '10', '-'
+    ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    if not result.stdout:
+        raise RuntimeError('ffmpeg produced no output')
+    return 'data:image/jpeg;base64,' + base64.b64encode(result.stdout).decode('ascii')
+
+def build_image_derivatives(local_path, source, timeout=None):
+    """
+    Generate every derivative width for an image and its placeholder. Returns the
+    catalog fields to store: intrinsic width/height, the comma-separated widths
+    generated, the LQIP and the content hash they were made for.
+    """
+    full_path = os.path.join(BASE_DIR, local_path)
+    meta = probe_video(full_path)  # ffprobe reads stills too
+    if not meta.get('width'):
+        raise RuntimeError('could not read image dimensions')
+    widths = [w for w in DERIVATIVE_WIDTHS if w < meta['width']]
+    for width in widths:
+        generate_image_derivative(local_path, source, width, timeout)
+    return {'width': meta['width'], 'height': meta['height'], 'content_hash': source[0],
+            'derivatives': ','.join(str(w) for w in widths), 'lqip': make_lqip(full_path, timeout)}
+
+def store_image_derivatives(db, local_path, mtime, fields):
+    """Record an image's derivatives in the catalog and the store. The caller commits."""
+    for width in filter(None, fields['derivatives'].split(',')):
+        record_derivative(db, derivative_path_for(fields['content_hash'], f'w{width}', 'jpg'))
+    # Only if the file is unchanged since we started; otherwise its upsert re-queued it
+    db.execute("""UPDATE media SET width = ?, height = ?, derivatives = ?, lqip = ?, content_hash = ?
+                  WHERE path = ? AND mtime = ?""",
+               (fields['width'], fields['height'], fields['derivatives'], fields['lqip'],
+                fields['content_hash'], local_path, mtime))
+
+def image_srcset(row):
+    """srcset value for an image's catalog row, or None until its derivatives exist."""
+    if row is None or not row['derivatives'] or not row['content_hash']:
+        return None
+    candidates = [f"{url_for('files', filename=derivative_path_for(row['content_hash'], f'w{w}', 'jpg'))} {w}w"
+                  for w in row['derivatives'].split(',')]
+    candidates.append(f"{url_for('files', filename=row['path'])} {row['width']}w")
+    return ', '.join(candidates)
+
+# --- Negotiated image variants ---
+# /files answers image requests with an AVIF or WebP copy when the client lists
+# the type in Accept and the copy is smaller than the original. Copies are made
+# by background jobs the first time they are wanted and stored next to their
+# source in the store: original.<fmt> for uploads, w320.<fmt> for a derivative.
+# Until then the source is served. IMAGE_VARIANT_FORMATS sets the preference order ('' turns this off).
+IMAGE_VARIANTS = {
+    'avif': ('image/avif', ['-c:v', 'libaom-av1', '-still-picture', '1', '-crf', '32', '-f', 'avif']),
+    'webp': ('image/webp', ['-c:v', 'libwebp', '-quality', '80', '-f', 'webp']),
+}
+IMAGE_VARIANT_FORMATS = [f for f in os.environ.get('IMAGE_VARIANT_FORMATS', 'avif,webp').split(',')
+                         if f in IMAGE_VARIANTS]
+# Vector/icon formats, animations, and files that are already compact
+NO_VARIANT_EXTENSIONS = NO_DERIVATIVE_EXTENSIONS | {'.gif', '.webp'}
+
+def can_vary_image(local_path):
+    return is_image(local_path) and os.path.splitext(local_path)[1].lower() not in NO_VARIANT_EXTENSIONS
+
+def variant_path_for(local_path, fmt, content_hash=None):
+    """
+    Store path of the `fmt` copy of an image: a sibling for files already in the
+    store, else original.<fmt> under the upload's `content_hash`.
+    """
+    if parse_store_path(local_path) is not None:
+        return os.path.splitext(local_path)[0] + '.' + fmt
+    return derivative_path_for(content_hash, 'original', fmt)
+
+def generate_image_variant(local_path, fmt, source, timeout=None):
+    """Transcode an image (original or derivative) to `fmt` unless the copy exists; returns its path."""
+    variant_path = variant_path_for(local_path, fmt, source[0])
+    full_variant_path = os.path.join(BASE_DIR, variant_path)
+    full_source_path = os.path.join(BASE_DIR, local_path)
+    with single_flight(variant_path):
+        if not os.path.exists(full_variant_path):
+            ffmpeg_to_file(['-i', full_source_path], ['-frames:v', '1', *IMAGE_VARIANTS[fmt][1]],
+                           full_variant_path, timeout, guard=(full_source_path, source[1]))
+    return variant_path
+
+# --- Playable video renditions ---
+# Videos in containers or codecs browsers can't play are transcoded in the
+# background to H.264/AAC MP4 with the index up front (faststart), stored in the
+# derivative store as playable.mp4. The catalog's `playable` column points at the rendition and
+# payloads expose it as playable_url.
+WEB_VIDEO_EXTENSIONS = {'.mp4', '.webm', '.mov'}
+WEB_VIDEO_CODECS = {'h264', 'vp8', 'vp9', 'av1'}
+TRANSCODE_TIMEOUT = int(os.environ.get('TRANSCODE_TIMEOUT', 3600))
+
+def needs_transcode(local_path, codec=None):
+    """True if browsers can't play the video as stored; `codec` is the probed video codec, if known."""
+    if os.path.splitext(local_path)[1].lower() not in WEB_VIDEO_EXTENSIONS:
+        return True
+    return codec is not None and codec not in WEB_VIDEO_CODECS
+
+def playable_path_for(content_hash):
+    return derivative_path_for(content_hash, 'playable', 'mp4')
+
+def transcode_video(local_path, source, timeout=None):
+    """Write the MP4 rendition of a video unless it exists; returns its path."""
+    playable_path = playable_path_for(source[0])
+    full_playable_path = os.path.join(BASE_DIR, playable_path)
+    full_source_path = os.path.join(BASE_DIR, local_path)
+    with single_flight(playable_path):
+        if not os.path.exists(full_playable_path):
+            print(f"Transcoding {local_path}...")
+            ffmpeg_to_file(
+                ['-i', full_source_path],
+                ['-map', '0:v:0', '-map', '0:a:0?',
+                 '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p',
+                 # libx264 needs even dimensions
+                 '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                 '-c:a', 'aac', '-b:a', '128k', '-movflags', '+faststart', '-f', 'mp4'],
+                full_playable_path, timeout, guard=(full_source_path, source[1]))
+    return playable_path
+
+# MP4/QuickTime files written with the movie header (moov) after the media data
+# make players fetch the tail of the file before the first frame. They are
+# remuxed in place (stream copy, moov first) by a background job.
+FASTSTART_FORMATS = {'.mp4': 'mp4', '.mov': 'mov'}
+
+def moov_after_mdat(full_path):
+    """Walk the top-level boxes of an MP4/QuickTime file: True if moov follows mdat."""
+    seen_mdat = False
+    try:
+        with open(full_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset + 8 <= file_size:
+                f.seek(offset)
+                size, box_type = struct.unpack('>I4s', f.read(8))
+                if size == 1:  # 64-bit size follows the type
+                    size = struct.unpack('>Q', f.read(8))[0]
+                elif size == 0:  # box runs to the end of the file
+                    size = file_size - offset
+                if size < 8:
+                    return False  # not a box structure we understand
+                if box_type == b'moov':
+                    return seen_mdat
+                if box_type == b'mdat':
+                    seen_mdat = True
+                offset += size
+    except (OSError, struct.error):
+        pass
+    return False  # no moov (yet): nothing to move
+
+def needs_faststart(local_path):
+    ext = os.path.splitext(local_path)[1].lower()
+    return ext in FASTSTART_FORMATS and moov_after_mdat(os.path.join(BASE_DIR, local_path))
+
+def faststart_remux(local_path, timeout=None):
+    """
+    Rewrite a video in place with moov first, copying streams. Returns True if
+    the file was replaced, False if it needed nothing or changed under us.
+    """
+    full_path = os.path.join(BASE_DIR, local_path)
+    with single_flight(local_path):
+        before = os.stat(full_path)
+        if not moov_after_mdat(full_path):
+            return False
+        print(f"Moving moov to the front of {local_path}...")
+        return ffmpeg_to_file(
+            ['-i', full_path],
+            ['-map', '0:v?', '-map', '0:a?', '-map', '0:s?', '-c', 'copy',
+             '-movflags', '+faststart', '-f', FASTSTART_FORMATS[os.path.splitext(local_path)[1].lower()]],
+            full_path, timeout, guard=(full_path, before))
+
+def playable_url(row):
+    """URL a browser can play for a video's catalog row, or None while its rendition is pending."""
+    if row is None:
+        return None
+    if row['playable']:
+        return url_for('files', filename=row['playable'])
+    if needs_transcode(row['path'], row['codec']):
+        return None
+    return url_for('files', filename=row['path'])
+
+# --- HLS packaging ---
+# With HLS_PACKAGING=on, videos at least HLS_MIN_DURATION seconds long are
+# packaged into segmented renditions (one per HLS_LADDER rung at or below the
+# source height) plus a master playlist in the store's hls/ directory, served by
+# /hls. They are evicted with the rest of the store; evicted videos fall back to
+# progressive playback.
+HLS_PACKAGING = os.environ.get('HLS_PACKAGING', 'off') == 'on'
+HLS_MIN_DURATION = float(os.environ.get('HLS_MIN_DURATION', 300))
+HLS_LADDER = [(360, 800), (720, 2800), (1080, 5000)]  # (height, video kbit/s)
+HLS_SEGMENT_SECONDS = 6
+HLS_AUDIO_KBPS = 128
+
+def hls_dir_for(content_hash):
+    """Directory (relative to BASE_DIR) holding a video's HLS renditions."""
+    return derivative_path_for(content_hash, 'hls')
+
+def wants_hls(duration):
+    return HLS_PACKAGING and duration is not None and duration >= HLS_MIN_DURATION
+
+def package_hls(local_path, source, width, height, timeout=None):
+    """
+    Encode every ladder rendition into a temp directory, write the master
+    playlist, and swap the directory into place, unless it exists. Returns the
+    master playlist path, or None if the video changed while it was encoded.
+    """
+    stream_dir = hls_dir_for(source[0])
+    full_stream_dir = os.path.join(BASE_DIR, stream_dir)
+    full_source_path = os.path.join(BASE_DIR, local_path)
+    rungs = [(h, kbps) for h, kbps in HLS_LADDER if h <= height] or [(height - height % 2, HLS_LADDER[0][1])]
+    with single_flight(stream_dir):
+        if os.path.exists(os.path.join(full_stream_dir, 'master.m3u8')):
+            return stream_dir + '/master.m3u8'
+        tmp_dir = os.path.join(os.path.dirname(full_stream_dir),
+                               f'.{os.path.basename(full_stream_dir)}.{os.getpid()}.part')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            master = ['#EXTM3U', '#EXT-X-VERSION:3']
+            for rung_height, kbps in rungs:
+                rung_dir = os.path.join(tmp_dir, f'{rung_height}p')
+                os.makedirs(rung_dir)
+                print(f"Packaging {local_path} at {rung_height}p...")
+                subprocess.run([
+                    'ffmpeg', '-y', '-i', full_source_path,
+                    '-map', '0:v:0', '-map', '0:a:0?',
+                    '-vf', f'scale=-2:{rung_height}',
+                    '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+                    '-b:v', f'{kbps}k', '-maxrate', f'{kbps * 3 // 2}k', '-bufsize', f'{kbps * 2}k',
+                    # Fixed GOPs so every rendition's segments line up for switching
+                    '-g', '48', '-keyint_min', '48', '-sc_threshold', '0',
+                    '-c:a', 'aac', '-b:a', f'{HLS_AUDIO_KBPS}k', '-ac', '2',
+                    '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                    '-hls_segment_filename', os.path.join(rung_dir, 'seg%05d.ts'),
+                    os.path.join(rung_dir, 'index.m3u8')
+                ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+                rung_width = round(width * rung_height / height / 2) * 2
+                bandwidth = (kbps * 3 // 2 + HLS_AUDIO_KBPS) * 1000
+                master.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={rung_width}x{rung_height}')
+                master.append(f'{rung_height}p/index.m3u8')
+            with open(os.path.join(tmp_dir, 'master.m3u8'), 'w') as f:
+                f.write('\n'.join(master) + '\n')
+            st = os.stat(full_source_path)
+            if (st.st_size, st.st_mtime_ns) != (source[1].st_size, source[1].st_mtime_ns):
+                return None
+            shutil.rmtree(full_stream_dir, ignore_errors=True)
+            os.replace(tmp_dir, full_stream_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return stream_dir + '/master.m3u8'
+
+def stream_url(row):
+    """HLS master playlist URL for a video's catalog row, if it has been packaged."""
+    if row is None or not row['stream']:
+        return None
+    return url_for('hls', filename=row['stream'][len('.derivatives/'):])
+
+# --- Scrub sprites and hover previews ---
+# Each video gets a sprite sheet of SPRITE_COLUMNS x SPRITE_ROWS evenly spaced
+# frames with a WebVTT index (#xywh fragments) for scrub previews, and a short
+# muted low-bitrate clip for hover previews, so neither needs the video itself.
+SPRITE_COLUMNS = 5
+SPRITE_ROWS = 5
+SPRITE_TILE_WIDTH = 160
+PREVIEW_CLIP_SECONDS = 3
+PREVIEW_CLIP_WIDTH = 320
+
+def display_size(meta):
+    """(width, height) of a video as shown, i.e. after its rotation is applied."""
+    if meta.get('rotation') in (90, 270):
+        return meta['height'], meta['width']
+    return meta['width'], meta['height']
+
+def _vtt_timestamp(seconds):
+    ms = int(round(seconds * 1000))
+    return f'{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}'
+
+def generate_sprites(local_path, source, meta, timeout=None):
+    """
+    Write a video's sprite sheet and its WebVTT index unless they exist; returns
+    the index path, or None if the video changed while the sheet was made.
+    """
+    sheet_path = derivative_path_for(source[0], 'sprites', 'jpg')
+    vtt_path = derivative_path_for(source[0], 'sprites', 'vtt')
+    full_vtt_path = os.path.join(BASE_DIR, vtt_path)
+    full_source_path = os.path.join(BASE_DIR, local_path)
+    width, height = display_size(meta)
+    tile_width, tile_height = SPRITE_TILE_WIDTH, round(SPRITE_TILE_WIDTH * height / width / 2) * 2
+    interval = meta['duration'] / (SPRITE_COLUMNS * SPRITE_ROWS)
+    with single_flight(vtt_path):
+        if os.path.exists(full_vtt_path):
+            return vtt_path
+        if not ffmpeg_to_file(
+                # Keyframes are close enough for scrubbing and avoid decoding the whole video
+                ['-skip_frame', 'nokey', '-i', full_source_path],
+                ['-vf', f'fps=1/{interval:.3f},scale={tile_width}:{tile_height},tile={SPRITE_COLUMNS}x{SPRITE_ROWS}',
+                 '-frames:v', '1', '-f', 'image2', '-c:v', 'mjpeg', '-q:v', '5'],
+                os.path.join(BASE_DIR, sheet_path), timeout, guard=(full_source_path, source[1])):
+            return None
+        cues = ['WEBVTT', '']
+        for i in range(SPRITE_COLUMNS * SPRITE_ROWS):
+            x, y = i % SPRITE_COLUMNS * tile_width, i // SPRITE_COLUMNS * tile_height
+            cues.append(f'{_vtt_timestamp(i * interval)} --> {_vtt_timestamp((i + 1) * interval)}')
+            cues.append(f'{os.path.basename(sheet_path)}#xywh={x},{y},{tile_width},{tile_height}')
+            cues.append('')
+        tmp_path = full_vtt_path + f'.{os.getpid()}.part'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(cues))
+        os.replace(tmp_path, full_vtt_path)
+    return vtt_path
+
+def generate_preview_clip(local_path, source, duration, timeout=None):
+    """Write a short muted clip from THUMB_POSITION into the video unless it exists; returns its path."""
+    preview_path = derivative_path_for(source[0], 'preview', 'mp4')
+    full_preview_path = os.path.join(BASE_DIR, preview_path)
+    full_source_path = os.path.join(BASE_DIR, local_path)
+    start = duration * THUMB_POSITION if duration > PREVIEW_CLIP_SECONDS * 2 else 0
+    with single_flight(preview_path):
+        if not os.path.exists(full_preview_path):
+            ffmpeg_to_file(
+                ['-ss', f'{start:.3f}', '-t', str(PREVIEW_CLIP_SECONDS), '-i', full_source_path],
+                ['-an', '-vf', f'scale={PREVIEW_CLIP_WIDTH}:-2,fps=12',
+                 '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '32', '-pix_fmt', 'yuv420p',
+                 '-movflags', '+faststart', '-f', 'mp4'],
+                full_preview_path, timeout, guard=(full_source_path, source[1]))
+    return preview_path
+
+def video_derivative_urls(row):
+    """Renditions and previews of a video for its payload item (None where not made yet)."""
+    return {
+        'playable_url': playable_url(row),
+        'stream_url': stream_url(row),
+        'sprites_url': url_for('files', filename=row['sprites']) if row is not None and row['sprites'] else None,
+        'preview_url': url_for('files', filename=row['preview']) if row is not None and row['preview'] else None
+    }
+
+def queue_missing_derivatives(db):
+    """
+    Queue jobs for catalogued media lacking outputs: ones evicted from the store,
+    dropped by a migration, or added since the media was probed. The caller commits.
+    """
+    rows = db.execute("""SELECT path, type, mtime, duration, codec, thumb, playable, stream, sprites, preview
+                         FROM media WHERE type = 'video' AND (thumb IS NULL OR playable IS NULL
+                         OR (duration IS NOT NULL AND (stream IS NULL OR sprites IS NULL OR preview IS NULL)))
+                         """).fetchall()
+    for row in rows:
+        if row['thumb'] is None:
+            enqueue_job(db, 'thumbnail', row['path'], row['mtime'])
+        if row['playable'] is None and needs_transcode(row['path'], row['codec']):
+            enqueue_job(db, 'transcode', row['path'], row['mtime'])
+        if row['duration'] is None:
+            continue  # the indexer queues the rest once the video is probed
+        if row['sprites'] is None:
+            enqueue_job(db, 'sprites', row['path'], row['mtime'])
+        if row['preview'] is None:
+            enqueue_job(db, 'preview', row['path'], row['mtime'])
+        # Evicted renditions ('') are left alone
+        if row['stream'] is None and wants_hls(row['duration']):
+            enqueue_job(db, 'hls', row['path'], row['mtime'])
+    for row in db.execute("SELECT path, mtime FROM media WHERE type = 'image' AND derivatives IS NULL").fetchall():
+        if can_derive_image(row['path']):
+            enqueue_job(db, 'derivatives', row['path'], row['mtime'])
+
+def get_video_thumbnail_local(local_path, row=None):
+    """
+    Thumbnail URL for a video, from its catalog row (looked up unless given). If
+    there is no thumbnail yet it is queued for the background workers once the
+    request is done (see queue_missing_thumbnails) and the default thumbnail is
+    returned meanwhile; the client can pick up the real one from /api/thumbnail.
+    """
+    if row is None:
+        row = get_db().execute('SELECT thumb FROM media WHERE path = ?', (local_path,)).fetchone()
+    if row is not None and row['thumb']:
+        return url_for('files', filename=row['thumb'])
+    g.setdefault('_pending_thumbs', set()).add(local_path)
+    return url_for('files', filename=DEFAULT_VIDEO_THUMB)
+
+def queue_missing_thumbnails(db, paths):
+    """
+    Queue thumbnail jobs for videos a request found without one, skipping those
+    whose job (or faststart remux) is already queued or running, or is backing
+    off on an unchanged file, so a page of pending videos only writes when there
+    is something new to queue.
+    Returns how many were queued. The caller commits.
+    """
+    paths = sorted(paths)
+    jobs = {}
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i + 500]
+        for job in db.execute("""SELECT kind, path, status, source_mtime, next_retry FROM jobs
+                                 WHERE kind IN ('thumbnail', 'faststart') AND path IN (%s)
+                                 ORDER BY kind = 'faststart'""" % ','.join('?' * len(chunk)), chunk):
+            # A pending remux stands in for the thumbnail job; it queues one when done
+            if job['kind'] == 'thumbnail' or job['status'] in ('queued', 'running'):
+                jobs[job['path']] = job
+    now = time.time()
+    queued = 0
+    for path in paths:
         try:
-            subprocess.run([
-                'ffmpeg',
-                '-i', video_full_path,
-                '-ss', '00:00:01.000',  # extract frame at 1 second
-                '-vframes', '1',
-                full_thumb_path
-            ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            print(f"Thumbnail generated: {thumb_path}")
-        except (subprocess.CalledProcessError, FileNotFoundError) as e:
-            print(f"Error generating thumbnail for {local_path}: {e}")
-            return url_for('files', filename='default_video_thumb.png')
-    return url_for('files', filename=thumb_path.replace('\\', '/'))
-
-def get_interfaith_media():
+            mtime = os.stat(os.path.join(BASE_DIR, path)).st_mtime
+        except OSError:
+            continue
+        job = jobs.get(path)
+        if job is not None and (job['status'] in ('queued', 'running') or (
+                job['status'] == 'failed' and job['source_mtime'] == mtime and (job['next_retry'] or 0) > now)):
+            continue
+        enqueue_job(db, 'thumbnail', path, mtime)
+        queued += 1
+    return queued
+
+def queue_missing_variants(db, variants):
     """
-    Returns a list of dictionaries for media in the interfaith directory.
-    - For images: { 'url': <url>, 'type': 'image' }
-    - For videos: { 'url': <url>, 'type': 'video', 'thumb': <thumb_url> }
+    Queue image variant jobs for (format, path, source mtime) a request found
+    missing, skipping those already queued or running, or backing off on an
+    unchanged file, so repeated GETs of a pending image only read.
+    Returns how many were queued. The caller commits.
     """
-    print("getting all the interfaith media")
-    media = []
-    if os.path.exists(INTERFAITH_DIR):
-        for item in os.listdir(INTERFAITH_DIR):
-            if item.endswith('_thumb.jpg'):
+    variants = sorted(variants)
+    jobs = {}
+    for i in range(0, len(variants), 500):
+        chunk = variants[i:i + 500]
+        for job in db.execute("""SELECT kind, path, status, source_mtime, next_retry FROM jobs
+                                 WHERE (kind, path) IN (VALUES %s)""" % ','.join(['(?, ?)'] * len(chunk)),
+                              [value for fmt, path, mtime in chunk for value in (fmt, path)]):
+            jobs[job['kind'], job['path']] = job
+    now = time.time()
+    queued = 0
+    for fmt, path, mtime in variants:
+        job = jobs.get((fmt, path))
+        if job is not None and (job['status'] in ('queued', 'running') or (
+                job['status'] == 'failed' and job['source_mtime'] == mtime and (job['next_retry'] or 0) > now)):
+            continue
+        enqueue_job(db, fmt, path, mtime)
+        queued += 1
+    return queued
+
+# --- Gallery tree cache ---
+# Each gallery directory's listing is cached with the directory's inode/mtime.
+# Serving the tree costs one stat per directory visited; only directories whose
+# mtime changed are re-listed, and subtrees of removed directories are dropped.
+_gallery_cache = {}
+_gallery_lock = threading.Lock()
+
+def _gallery_listing(entry_records):
+    entries = []
+    for entry in entry_records:
+        if entry.kind == 'dir':
+            entries.append({'type': 'folder', 'name': entry.name})
+        elif entry.kind == 'image':
+            entries.append({
+                'type': 'image',
+                'name': entry.name,
+                'url': url_for('files', filename=entry.rel_path),
+                '_path': entry.rel_path  # derivative fields are looked up per request, they land later
+            })
+        elif entry.kind == 'video':
+            entries.append({
+                'type': 'video',
+                'name': entry.name,
+                'url': url_for('files', filename=entry.rel_path),
+                '_path': entry.rel_path  # the thumbnail is looked up per request too
+            })
+    return entries
+
+def _store_gallery_node(folder, stamp, entries):
+    node = {'stamp': stamp, 'entries': entries}
+    with _gallery_lock:
+        old = _gallery_cache.get(folder)
+        _gallery_cache[folder] = node
+        if old is not None:
+            # Forget cached subtrees of folders that are no longer there
+            kept = {e['name'] for e in entries if e['type'] == 'folder'}
+            for e in old['entries']:
+                if e['type'] == 'folder' and e['name'] not in kept:
+                    prefix = os.path.join(folder, e['name'])
+                    for key in [k for k in _gallery_cache if k == prefix or k.startswith(prefix + os.sep)]:
+                        del _gallery_cache[key]
+    return node
+
+def _prime_gallery_cache(folder):
+    """Fill the cache for a whole subtree in one parallel scan."""
+    st = os.stat(folder)
+    stamps = {folder: (st.st_ino, st.st_mtime_ns)}
+    records = {folder: []}
+    for entry in parallel_walk_media([folder]):
+        records.setdefault(os.path.dirname(entry.path), []).append(entry)
+        if entry.kind == 'dir':
+            # Stat the directory before it is listed so a concurrent change is not missed
+            dst = entry.entry.stat()
+            stamps[entry.path] = (dst.st_ino, dst.st_mtime_ns)
+            records.setdefault(entry.path, [])
+    for path, entry_records in records.items():
+        node = _store_gallery_node(path, stamps[path], _gallery_listing(entry_records))
+        if path == folder:
+            root_node = node
+    return root_node
+
+def _gallery_node(folder):
+    """Return the cached listing for a gallery directory, re-listing it only if it changed."""
+    st = os.stat(folder)
+    stamp = (st.st_ino, st.st_mtime_ns)
+    node = _gallery_cache.get(folder)
+    if node is not None and node['stamp'] == stamp:
+        return node
+    if node is None and not _gallery_cache:
+        return _prime_gallery_cache(folder)
+    return _store_gallery_node(folder, stamp, _gallery_listing(walk_media(folder, recursive=False)))
+
+def _gallery_subtree(folder, depth):
+    """
+    Listing of a gallery folder with subfolders expanded `depth` levels (all of
+    them for None). Walked with an explicit stack so deep trees cannot exhaust
+    the recursion limit; a folder removed while we read it is left out.
+    """
+    result = []
+    # (folder, levels left, list to fill, its node and the list holding that node)
+    stack = [(folder, depth, result, None, None)]
+    while stack:
+        folder, depth, structure, parent_node, siblings = stack.pop()
+        try:
+            entries = _gallery_node(folder)['entries']
+        except OSError:
+            if parent_node is None:
+                raise
+            siblings[:] = [n for n in siblings if n is not parent_node]  # removed while we were reading
+            continue
+        rows = catalog_rows(get_db(), [item['_path'] for item in entries if '_path' in item])
+        for item in entries:
+            if item['type'] == 'image':
+                row = rows.get(item['_path'])
+                item = dict(item, srcset=image_srcset(row), **media_metadata(row))
+                del item['_path']
+            elif item['type'] == 'video':
+                row = rows.get(item['_path'])
+                item = dict(item, thumb=get_video_thumbnail_local(item['_path'], row),
+                            **video_derivative_urls(row), **media_metadata(row))
+                del item['_path']
+            if item['type'] != 'folder':
+                structure.append(dict(item))
                 continue
-            local_rel = os.path.join('interfaith', item).replace('\\', '/')
-            if is_image(item):
-                media.append({'url': url_for('files', filename=local_rel), 'type': 'image', 'name': item})
-            elif is_video(item):
-                thumb = get_video_thumbnail_local(local_rel)
-                media.append({'url': url_for('files', filename=local_rel), 'type': 'video', 'thumb': thumb, 'name': item})
-    print(f"get_interfaith_media: Loaded {len(media)} items")
-    return media
-
-def get_gallery_structure():
+            path = os.path.join(folder, item['name'])
+            node = {
+                'type': 'folder',
+                'name': item['name'],
+                'path': os.path.relpath(path, GALLERY_DIR).replace('\\', '/'),
+                'children': [],
+                'album_thumb': None
+            }
+            try:
+                node['album_thumb'] = album_cover_url(get_db(), os.path.relpath(path, BASE_DIR).replace('\\', '/'))
+            except OSError:
+                continue  # removed while we were reading
+            if depth is None or depth > 1:
+                stack.append((path, None if depth is None else depth - 1, node['children'], node, structure))
+            else:
+                node['truncated'] = True
+            structure.append(node)
+    return result
+
+def get_gallery_structure(path=None, depth=None):
     """
     Returns a tree structure representing the folder (album) structure.
-    - For images: { 'type': 'image', 'name': <name>, 'url': <url> }
-    - For videos: { 'type': 'video', 'name': <name>, 'url': <url>, 'thumb': <thumb_url> }
-    - For folders: { 'type': 'folder', 'name': <name>, 'children': <list>, 'album_thumb': <thumb_url> }
+    - For images: { 'type': 'image', 'name': <name>, 'url': <url>, 'srcset': <srcset or null> }
+    - For videos: { 'type': 'video', 'name': <name>, 'url': <url>, 'thumb': <thumb_url>, plus rendition/preview URLs }
+    - For folders: { 'type': 'folder', 'name': <name>, 'path': <path>, 'children': <list>, 'album_thumb': <thumb_url> }
+    `path` selects a subtree (relative to the gallery) and `depth` limits how many
+    folder levels are expanded; folders past the limit have 'truncated': True.
     """
-    def walk_folder(folder):
-        structure = []
-        for item in os.listdir(folder):
-            path = os.path.join(folder, item)
-            if os.path.isdir(path):
-                children = walk_folder(path)
-                album_thumb = find_album_thumbnail(children)
-                structure.append({
-                    'type': 'folder',
-                    'name': item,
-                    'children': children,
-                    'album_thumb': album_thumb
-                })
-            else:
-                rel_path = os.path.relpath(path, BASE_DIR).replace('\\', '/')
-                if is_image(item):
-                    structure.append({
-                        'type': 'image',
-                        'name': item,
-                        'url': url_for('files', filename=rel_path)
-                    })
-                elif is_video(item):
-                    thumb = get_video_thumbnail_local(rel_path)
-                    structure.append({
-                        'type': 'video',
-                        'name': item,
-                        'url': url_for('files', filename=rel_path),
-                        'thumb': thumb
-                    })
-        return structure
-
-    result = walk_folder(GALLERY_DIR) if os.path.exists(GALLERY_DIR) else []
+    folder = GALLERY_DIR
+    if path:
+        folder = os.path.normpath(os.path.join(GALLERY_DIR, path))
+        if not os.path.realpath(folder).startswith(os.path.realpath(GALLERY_DIR) + os.sep):
+            return []
+    if not os.path.isdir(folder):
+        return []
+    result = _gallery_subtree(folder, depth)
     print(f"get_gallery_structure: Loaded gallery with {len(result)} top-level items")
     return result
 
-def find_album_thumbnail(items):
+# --- Media catalog ---
+# Every image/video under the media roots is indexed in the `media` table so the
+# listing endpoints can answer with indexed reads instead of walking the disk.
+MEDIA_ROOTS = [
+    ('users', USERS_DIR),
+    ('interfaith', INTERFAITH_DIR),
+    ('gallery', GALLERY_DIR),
+    ('videos', VIDEOS_DIR),
+]
+FEED_ROOTS = ('users', 'interfaith', 'videos')
+TIKTOK_ROOTS = ('interfaith', 'gallery', 'videos')
+
+def catalog_record_for(rel_path):
     """
-    Recursively search for the first image or video thumbnail in a list of items.
-    Returns the URL of the thumbnail or None if not found.
+    Work out the catalog fields for a file path relative to BASE_DIR.
+    Returns a dict, or None if the path is not catalogued media.
     """
-    # First, look for an image
-    for item in items:
-        if item['type'] == 'image':
-            return item['url']
-    # Then, look for a video thumbnail
-    for item in items:
-        if item['type'] == 'video' and 'thumb' in item:
-            return item['thumb']
-        elif item['type'] == 'folder':
-            thumb = find_album_thumbnail(item['children'])
-            if thumb:
-                return thumb
-    return None
+    rel_path = rel_path.replace('\\', '/')
+    parts = rel_path.split('/')
+    name = parts[-1]
+    if is_image(name):
+        media_type = 'image'
+    elif is_video(name):
+        media_type = 'video'
+    else:
+        return None
+    root = parts[0]
+    if root == 'users':
+        # users/<user>/<tab>/[album/...]/<file>
+        if len(parts) < 4:
+            return None
+        user, tab, album = parts[1], parts[2], '/'.join(parts[3:-1])
+    elif root in ('interfaith', 'videos'):
+        # Only the top level of these folders is served
+        if len(parts) != 2:
+            return None
+        user, tab, album = root, root, ''
+    elif root == 'gallery':
+        user, tab, album = 'gallery', 'gallery', '/'.join(parts[1:-1])
+    else:
+        return None
+    return {'path': rel_path, 'root': root, 'user': user, 'tab': tab,
+            'album': album, 'name': name, 'type': media_type}
+
+def scan_media_files():
+    """Yield (rel_path, stat) for every media file under the media roots."""
+    roots = []
+    for root_name, root_dir in MEDIA_ROOTS:
+        if root_name == 'users' and os.path.isdir(USERS_DIR):
+            # Fan out per user so one large profile doesn't hold up the rest
+            roots.extend(os.path.join(USERS_DIR, user) for user in list_users())
+        elif root_name in ('interfaith', 'videos'):
+            roots.append((root_dir, False))
+        else:
+            roots.append(root_dir)
+    for entry in parallel_walk_media(roots, with_stat=True):
+        if entry.kind not in ('image', 'video'):
+            continue
+        try:
+            st = entry.entry.stat()
+        except OSError:
+            continue
+        yield entry.rel_path, st
+
+# Catalog columns describing a file's content and outputs made from it; cleared when it changes
+DERIVED_COLUMNS = ('content_hash', 'thumb', 'derivatives', 'playable', 'stream', 'sprites', 'preview', 'lqip')
+_KEEP_DERIVED = ', '.join(f'{column} = CASE WHEN media.size = excluded.size AND media.mtime = excluded.mtime '
+                          f'THEN media.{column} END' for column in DERIVED_COLUMNS)
+
+def catalog_upsert(db, record, size, mtime, priority=0):
+    db.execute('''INSERT INTO media (path, root, user, tab, album, name, type, size, mtime)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                  ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, ''' + _KEEP_DERIVED,
+               (record['path'], record['root'], record['user'], record['tab'], record['album'],
+                record['name'], record['type'], size, mtime))
+    row = db.execute('SELECT thumb, playable, derivatives, lqip FROM media WHERE path = ?',
+                     (record['path'],)).fetchone()
+    if record['type'] == 'video':
+        _video_indexer_wakeup.set()
+        if needs_faststart(record['path']):
+            # The remux rewrites the file, which would void anything made from it
+            # now; _run_faststart_job queues the rest once it is done
+            enqueue_job(db, 'faststart', record['path'], mtime, priority)
+            return
+        if row['thumb'] is None:
+            enqueue_job(db, 'thumbnail', record['path'], mtime, priority)
+        elif row['lqip'] is None:
+            enqueue_job(db, 'lqip', record['path'], mtime, priority)
+        # Containers browsers can't play are known from the name; codecs once the indexer has probed
+        if needs_transcode(record['path']) and row['playable'] is None:
+            enqueue_job(db, 'transcode', record['path'], mtime, priority)
+    elif can_derive_image(record['path']) and row['derivatives'] is None:
+        enqueue_job(db, 'derivatives', record['path'], mtime, priority)
+
+RECONCILE_BATCH = 500  # upserts per commit during a full scan
+
+def reconcile_media_catalog(db=None):
+    """
+    Rebuild or repair the media catalog from disk: new and changed files are
+    upserted, rows whose file has gone away are deleted. Commits every
+    RECONCILE_BATCH files, so a long scan never holds the write lock for long.
+    """
+    own_db = db is None
+    if own_db:
+        db = connect_db()
+    try:
+        known = {row['path']: (row['size'], row['mtime'], row['thumb'])
+                 for row in db.execute('SELECT path, size, mtime, thumb FROM media')}
+        seen = set()
+        added = updated = pending = 0
+        for rel_path, st in scan_media_files():
+            record = catalog_record_for(rel_path)
+            if record is None:
+                continue
+            seen.add(rel_path)
+            previous = known.get(rel_path)
+            if (previous is not None and previous[0] == st.st_size and previous[1] == st.st_mtime
+                    and (previous[2] or record['type'] != 'video')):
+                # Files catalogued before faststart remuxing existed still get checked
+                if record['type'] == 'video' and needs_faststart(rel_path):
+                    enqueue_job(db, 'faststart', rel_path, st.st_mtime)
+                    pending += 1
+            else:
+                if previous is None:
+                    added += 1
+                else:
+                    updated += 1
+                catalog_upsert(db, record, st.st_size, st.st_mtime)
+                pending += 1
+            if pending >= RECONCILE_BATCH:
+                db.commit()
+                pending = 0
+        removed = [path for path in known if path not in seen]
+        db.executemany('DELETE FROM media WHERE path = ?', [(path,) for path in removed])
+        queue_missing_derivatives(db)
+        refresh_all_tab_summaries(db)
+        db.execute('DELETE FROM album_covers WHERE override IS NULL')
+        db.commit()
+    finally:
+        if own_db:
+            db.close()
+    print(f"reconcile_media_catalog: {added} added, {updated} updated, {len(removed)} removed")
+    return {'added': added, 'updated': updated, 'removed': len(removed)}
+
+_initial_reconcile_thread = None
+
+def _initial_reconcile():
+    db = connect_db()
+    try:
+        if db.execute('SELECT 1 FROM media LIMIT 1').fetchone() is None:
+            reconcile_media_catalog(db)
+    except Exception as e:
+        print(f"Initial catalog scan: {e}")
+    finally:
+        db.close()
+
+def start_initial_reconcile():
+    """Build the catalog from disk in the background if it is empty (first start)."""
+    global _initial_reconcile_thread
+    if _initial_reconcile_thread is not None:
+        return
+    _initial_reconcile_thread = threading.Thread(target=_initial_reconcile, name='catalog-reconcile', daemon=True)
+    _initial_reconcile_thread.start()
+
+def catalog_sync_path(db, rel_path, recursive=True, priority=0, refresh=True):
+    """
+    Bring the catalog in line with disk for a single file or directory (relative
+    to BASE_DIR). Used for incremental updates from the watcher and the
+    upload/delete endpoints; `priority` is given to any jobs this queues. With
+    refresh=False the tab summaries and album covers are left to the caller,
+    to be done once for a batch of paths. The caller commits.
+    """
+    rel_path = rel_path.replace('\\', '/').strip('/')
+    full_path = os.path.join(BASE_DIR, rel_path)
+    prefix = rel_path + '/'
+    if os.path.isdir(full_path):
+        # Upsert what is there, then drop rows under the directory that are gone
+        present = set()
+        for entry in walk_media(full_path, recursive):
+            if entry.kind in ('image', 'video'):
+                present.add(entry.rel_path)
+                _catalog_sync_file(db, entry.rel_path, priority)
+        if recursive:
+            rows = db.execute('SELECT path FROM media WHERE substr(path, 1, ?) = ?',
+                              (len(prefix), prefix))
+        else:
+            rows = db.execute("""SELECT path FROM media WHERE substr(path, 1, ?) = ?
+                                 AND instr(substr(path, ?), '/') = 0""",
+                              (len(prefix), prefix, len(prefix) + 1))
+        gone = [(row['path'],) for row in rows if row['path'] not in present]
+        db.executemany('DELETE FROM media WHERE path = ?', gone)
+    elif os.path.exists(full_path):
+        _catalog_sync_file(db, rel_path, priority)
+    else:
+        # Deleted file, or a deleted/renamed directory
+        db.execute('DELETE FROM media WHERE path = ? OR substr(path, 1, ?) = ?',
+                   (rel_path, len(prefix), prefix))
+    if refresh:
+        refresh_summaries_for_path(db, rel_path)
+        invalidate_album_covers(db, rel_path)
+
+def _catalog_sync_file(db, rel_path, priority=0):
+    record = catalog_record_for(rel_path)
+    if record is None:
+        return
+    try:
+        st = os.stat(os.path.join(BASE_DIR, rel_path))
+    except OSError:
+        db.execute('DELETE FROM media WHERE path = ?', (rel_path,))
+        return
+    catalog_upsert(db, record, st.st_size, st.st_mtime, priority)
+
+def store_thumbnail(db, content_hash):
+    """
+    A thumbnail landed in the store: point every video with that content at it
+    and queue their placeholders. The caller commits.
+    """
+    thumb = thumb_path_for(content_hash)
+    if not os.path.exists(os.path.join(BASE_DIR, thumb)):
+        return  # thrown away because the video changed
+    record_derivative(db, thumb)
+    rows = db.execute("SELECT path, mtime, thumb, lqip FROM media WHERE content_hash = ? AND type = 'video'",
+                      (content_hash,)).fetchall()
+    for row in rows:
+        if row['thumb'] != thumb:
+            # The placeholder is made from the thumbnail, so it is re-made with it
+            db.execute('UPDATE media SET thumb = ?, lqip = NULL WHERE path = ?', (thumb, row['path']))
+            invalidate_album_covers(db, row['path'])
+        if row['thumb'] != thumb or row['lqip'] is None:
+            enqueue_job(db, 'lqip', row['path'], row['mtime'])
+
+# --- Album covers ---
+# Covers are computed once per album directory from the catalog and stored in
+# album_covers; a change anywhere under an album drops the computed covers of it
+# and its ancestors. Users can pin a cover with an override.
+def _path_range(dir_rel):
+    """Bounds for an indexed range scan over catalog paths under a directory."""
+    prefix = dir_rel.rstrip('/') + '/'
+    return prefix, prefix[:-1] + chr(ord('/') + 1)
+
+def _compute_album_cover(db, dir_rel):
+    # Prefer an image directly in the album, then any image below it, then a video thumbnail
+    low, high = _path_range(dir_rel)
+    row = db.execute("""SELECT path, type, thumb FROM media
+                        WHERE path >= ? AND path < ? AND (type = 'image' OR thumb IS NOT NULL)
+                        ORDER BY type = 'video', instr(substr(path, ?), '/') > 0, path LIMIT 1""",
+                     (low, high, len(low) + 1)).fetchone()
+    if row is None:
+        return None
+    return row['path'] if row['type'] == 'image' else row['thumb']
 
-def get_all_videos():
+def _cover_for_media(db, media_path):
+    row = db.execute('SELECT type, thumb FROM media WHERE path = ?', (media_path,)).fetchone()
+    if row is None:
+        return None
+    return media_path if row['type'] == 'image' else row['thumb']
+
+def album_cover_path(db, dir_rel):
+    """Cover path (relative to BASE_DIR) for an album directory, or None."""
+    row = db.execute('SELECT cover, override FROM album_covers WHERE dir = ?', (dir_rel,)).fetchone()
+    if row is not None:
+        if row['override']:
+            cover = _cover_for_media(db, row['override'])
+            if cover:
+                return cover
+        elif row['cover'] is not None or row['override'] is None:
+            return row['cover']
+    cover = _compute_album_cover(db, dir_rel)
+    # Cached when the request is done, in one transaction for all albums on the page
+    g.setdefault('_pending_covers', {})[dir_rel] = cover
+    return cover
+
+@app.after_request
+def flush_deferred_writes(response):
     """
-    Returns a shuffled list of video URLs from all directories.
+    Write what serving this request found missing (album covers to cache, video
+    thumbnails and image variants to queue), with a single commit.
     """
-    print("getting all the videos")
-    videos = []
-    # From interfaith
-    if os.path.exists(INTERFAITH_DIR):
-        for item in os.listdir(INTERFAITH_DIR):
-            if item.endswith('_thumb.jpg'):
+    covers = g.pop('_pending_covers', None)
+    thumbs = g.pop('_pending_thumbs', None)
+    variants = g.pop('_pending_variants', None)
+    if not covers and not thumbs and not variants:
+        return response
+    db = get_db()
+    try:
+        if covers:
+            db.executemany("""INSERT INTO album_covers (dir, cover) VALUES (?, ?)
+                              ON CONFLICT(dir) DO UPDATE SET cover = excluded.cover""", covers.items())
+        queued = queue_missing_thumbnails(db, thumbs) if thumbs else 0
+        queued += queue_missing_variants(db, variants) if variants else 0
+        if db.in_transaction:
+            db.commit()
+    except sqlite3.OperationalError as e:
+        # Both are redone by the next request that needs them
+        print(f"Could not write deferred cache rows: {e}")
+        db.rollback()
+        return response
+    if queued:
+        _job_wakeup.set()
+    return response
+
+def album_cover_url(db, dir_rel):
+    cover = album_cover_path(db, dir_rel)
+    return url_for('files', filename=cover) if cover else None
+
+def invalidate_album_covers(db, *rel_paths):
+    """Drop computed covers for every album containing (or equal to) any of rel_paths."""
+    dirs = set()
+    for rel_path in rel_paths:
+        parts = rel_path.split('/')
+        dirs.update('/'.join(parts[:i]) for i in range(2, len(parts) + 1))
+    dirs = sorted(dirs)
+    for i in range(0, len(dirs), 500):
+        chunk = dirs[i:i + 500]
+        db.execute('UPDATE album_covers SET cover = NULL WHERE override IS NOT NULL AND dir IN (%s)'
+                   % ','.join('?' * len(chunk)), chunk)
+        db.execute('DELETE FROM album_covers WHERE override IS NULL AND dir IN (%s)'
+                   % ','.join('?' * len(chunk)), chunk)
+
+@app.route('/api/profile/<username>/<tab>/album_cover', methods=['POST'])
+def api_set_album_cover(username, tab):
+    try:
+        data = request.json
+        album_path = data.get('album_path')
+        media_path = data.get('media_path')  # relative to the tab; empty to go back to automatic
+        if not album_path:
+            return jsonify({'error': 'Album path is required'}), 400
+        # Both paths must resolve to something inside this tab, itself inside the users folder
+        tab_dir = os.path.join(USERS_DIR, username, tab)
+        real_tab_dir = os.path.realpath(tab_dir)
+        album_dir = os.path.normpath(os.path.join(tab_dir, album_path.strip('/')))
+        if (not real_tab_dir.startswith(os.path.realpath(USERS_DIR) + os.sep)
+                or not os.path.realpath(album_dir).startswith(real_tab_dir + os.sep)):
+            return jsonify({'error': 'Invalid album path'}), 400
+        if not os.path.isdir(album_dir):
+            return jsonify({'error': 'Album not found'}), 404
+        dir_rel = os.path.relpath(album_dir, BASE_DIR).replace('\\', '/')
+        db = get_db()
+        override = None
+        if media_path:
+            media_full = os.path.normpath(os.path.join(tab_dir, media_path.strip('/')))
+            if not os.path.realpath(media_full).startswith(real_tab_dir + os.sep):
+                return jsonify({'error': 'Invalid media path'}), 400
+            override = os.path.relpath(media_full, BASE_DIR).replace('\\', '/')
+            if _cover_for_media(db, override) is None:
+                return jsonify({'error': 'Media not found or has no thumbnail'}), 404
+        db.execute("""INSERT INTO album_covers (dir, cover, override) VALUES (?, NULL, ?)
+                      ON CONFLICT(dir) DO UPDATE SET override = excluded.override, cover = NULL""",
+                   (dir_rel, override))
+        db.commit()
+        return jsonify({'success': True, 'album_thumb': album_cover_url(db, dir_rel)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# --- Tab summaries ---
+# Per-tab aggregates (counts, bytes, derived tab type) for /api/profile. They are
+# refreshed whenever the catalog changes under a tab, so opening a profile costs
+# one row per tab instead of a walk of every album.
+def refresh_tab_summary(db, user, tab):
+    tab_path = os.path.join(USERS_DIR, user, tab)
+    if not os.path.isdir(tab_path):
+        db.execute('DELETE FROM tab_summary WHERE user = ? AND tab = ?', (user, tab))
+        return None
+    if os.path.exists(os.path.join(tab_path, 'story.json')):
+        tab_type = 'story'
+    else:
+        tab_type = detect_tab_type(tab_path)
+    album_count = sum(1 for entry in walk_media(tab_path, recursive=False) if entry.kind == 'dir')
+    row = db.execute("""SELECT COUNT(*) AS media_count,
+                               COALESCE(SUM(type = 'image'), 0) AS image_count,
+                               COALESCE(SUM(type = 'video'), 0) AS video_count,
+                               COALESCE(SUM(size), 0) AS total_bytes
+                        FROM media WHERE root = 'users' AND user = ? AND tab = ?""", (user, tab)).fetchone()
+    summary = {'user': user, 'tab': tab, 'tab_type': tab_type, 'album_count': album_count, **dict(row)}
+    db.execute("""INSERT OR REPLACE INTO tab_summary
+                  (user, tab, tab_type, media_count, image_count, video_count, album_count, total_bytes)
+                  VALUES (:user, :tab, :tab_type, :media_count, :image_count, :video_count, :album_count, :total_bytes)""",
+               summary)
+    return summary
+
+def refresh_summaries_for_path(db, rel_path):
+    """Refresh the summaries of whichever tab(s) a changed path belongs to."""
+    refresh_summaries_for_paths(db, [rel_path])
+
+def refresh_summaries_for_paths(db, rel_paths):
+    """Refresh the summary of every tab a batch of changed paths touches, once per tab."""
+    tabs = set()
+    users = set()
+    for rel_path in rel_paths:
+        parts = rel_path.split('/')
+        if parts[0] != 'users' or len(parts) < 2:
+            continue
+        if len(parts) >= 3:
+            tabs.add((parts[1], parts[2]))
+        else:
+            users.add(parts[1])  # a whole user directory changed
+    for user in users:
+        tabs.update((user, tab) for tab in list_tabs(user))
+        tabs.update((user, row['tab']) for row in db.execute('SELECT tab FROM tab_summary WHERE user = ?', (user,)))
+    for user, tab in sorted(tabs):
+        refresh_tab_summary(db, user, tab)
+
+def refresh_all_tab_summaries(db):
+    db.execute('DELETE FROM tab_summary')
+    if not os.path.exists(USERS_DIR):
+        return
+    for user in list_users():
+        for tab in list_tabs(user):
+            refresh_tab_summary(db, user, tab)
+
+# --- Catalog watcher ---
+# Keeps the catalog fresh from filesystem events: inotify on Linux, otherwise a
+# poller that compares directory mtimes. CATALOG_WATCHER can force 'inotify',
+# 'poll' or 'off'.
+CATALOG_WATCHER = os.environ.get('CATALOG_WATCHER', 'auto')
+CATALOG_POLL_INTERVAL = float(os.environ.get('CATALOG_POLL_INTERVAL', 5))
+CATALOG_WATCH_DIRS = [USERS_DIR, GALLERY_DIR, INTERFAITH_DIR, VIDEOS_DIR]
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0x00000800
+_IN_CLOEXEC = 0x00080000
+_IN_WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE
+                  | _IN_DELETE | _IN_DELETE_SELF)
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+_watcher_thread = None
+
+def _apply_catalog_changes(paths):
+    """Apply a batch of changed paths (relative to BASE_DIR) to the catalog."""
+    if not paths:
+        return
+    db = connect_db()
+    try:
+        for rel_path in sorted(paths):
+            catalog_sync_path(db, rel_path, refresh=False)
+        refresh_summaries_for_paths(db, paths)
+        invalidate_album_covers(db, *paths)
+        db.commit()
+    except Exception as e:
+        print(f"Catalog watcher: error applying changes: {e}")
+    finally:
+        db.close()
+
+def _load_libc_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+def _inotify_watch_loop(libc):
+    fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        print("Catalog watcher: inotify_init1 failed, falling back to polling")
+        return _poll_watch_loop()
+    watches = {}
+
+    def add_tree(top):
+        dirs = [top] + [entry.path for entry in walk_media(top) if entry.kind == 'dir']
+        for dirpath in dirs:
+            wd = libc.inotify_add_watch(fd, os.fsencode(dirpath), _IN_WATCH_MASK)
+            if wd >= 0:
+                watches[wd] = dirpath
+
+    for top in CATALOG_WATCH_DIRS:
+        if os.path.isdir(top):
+            add_tree(top)
+    print(f"Catalog watcher: inotify watching {len(watches)} directories")
+    while True:
+        ready, _, _ = select.select([fd], [], [], 1.0)
+        if not ready:
+            continue
+        # Let a burst of events (e.g. a bulk upload) settle into one batch
+        time.sleep(0.2)
+        try:
+            data = os.read(fd, 1024 * 1024)
+        except BlockingIOError:
+            continue
+        changed = set()
+        overflow = False
+        pos = 0
+        while pos + _INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(data, pos)
+            pos += _INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            pos += length
+            if mask & _IN_Q_OVERFLOW:
+                overflow = True
                 continue
-            if is_video(item):
-                local_rel = os.path.join('interfaith', item).replace('\\', '/')
-                videos.append(url_for('files', filename=local_rel))
-    # From gallery (recursively)
-    if os.path.exists(GALLERY_DIR):
-        for root, dirs, files in os.walk(GALLERY_DIR):
-            for file in files:
-                if file.endswith('_thumb.jpg'):
-                    continue
-                if is_video(file):
-                    rel_path = os.path.relpath(os.path.join(root, file), BASE_DIR).replace('\\', '/')
-                    videos.append(url_for('files', filename=rel_path))
-    # From videos directory
-    if os.path.exists(VIDEOS_DIR):
-        for item in os.listdir(VIDEOS_DIR):
-            if item.endswith('_thumb.jpg'):
+            if mask & _IN_IGNORED:
+                watches.pop(wd, None)
+                continue
+            dirpath = watches.get(wd)
+            if dirpath is None or mask & _IN_DELETE_SELF:
                 continue
-            if is_video(item):
-                local_rel = os.path.join('videos', item).replace('\\', '/')
-                videos.append(url_for('files', filename=local_rel))
-    random.shuffle(videos)
-    print(f"get_all_videos: Loaded {len(videos)} videos")
-    return videos
+            full_path = os.path.join(dirpath, name) if name else dirpath
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                add_tree(full_path)
+            changed.add(os.path.relpath(full_path, BASE_DIR).replace('\\', '/'))
+        if overflow:
+            print("Catalog watcher: event queue overflowed, reconciling")
+            reconcile_media_catalog()
+        else:
+            _apply_catalog_changes(changed)
+
+def _snapshot_dir_mtimes():
+    mtimes = {}
+    for top in CATALOG_WATCH_DIRS:
+        if not os.path.isdir(top):
+            continue
+        mtimes[top] = os.stat(top).st_mtime_ns
+        for entry in walk_media(top):
+            if entry.kind == 'dir':
+                try:
+                    mtimes[entry.path] = entry.entry.stat().st_mtime_ns
+                except OSError:
+                    pass
+    return mtimes
+
+def _poll_watch_loop():
+    print(f"Catalog watcher: polling every {CATALOG_POLL_INTERVAL}s")
+    previous = _snapshot_dir_mtimes()
+    while True:
+        time.sleep(CATALOG_POLL_INTERVAL)
+        current = _snapshot_dir_mtimes()
+        db = connect_db()
+        try:
+            changed = []
+            for dirpath, mtime in current.items():
+                if previous.get(dirpath) != mtime:
+                    rel_dir = os.path.relpath(dirpath, BASE_DIR).replace('\\', '/')
+                    catalog_sync_path(db, rel_dir, recursive=False, refresh=False)
+                    changed.append(rel_dir)
+            for dirpath in previous:
+                if dirpath not in current:
+                    rel_dir = os.path.relpath(dirpath, BASE_DIR).replace('\\', '/')
+                    catalog_sync_path(db, rel_dir, refresh=False)
+                    changed.append(rel_dir)
+            refresh_summaries_for_paths(db, changed)
+            invalidate_album_covers(db, *changed)
+            db.commit()
+        except Exception as e:
+            print(f"Catalog watcher: error applying changes: {e}")
+        finally:
+            db.close()
+        previous = current
+
+def start_catalog_watcher():
+    """Start the background catalog watcher thread (once per process)."""
+    global _watcher_thread
+    if _watcher_thread is not None or CATALOG_WATCHER == 'off':
+        return
+    libc = _load_libc_inotify() if CATALOG_WATCHER in ('auto', 'inotify') else None
+    if libc is not None:
+        target, args = _inotify_watch_loop, (libc,)
+    else:
+        target, args = _poll_watch_loop, ()
+    _watcher_thread = threading.Thread(target=target, args=args, name='catalog-watcher', daemon=True)
+    _watcher_thread.start()
+
+def media_row_to_item(row):
+    """Build the JSON item for a catalog row."""
+    item = {'type': row['type'], 'name': row['name'], 'url': url_for('files', filename=row['path'])}
+    item.update(media_metadata(row))
+    if row['type'] == 'image':
+        item['srcset'] = image_srcset(row)
+    elif row['type'] == 'video':
+        item['thumb'] = get_video_thumbnail_local(row['path'], row)
+        item.update(video_derivative_urls(row))
+    return item
+
+def video_row_to_item(row):
+    """Video index entry for a catalog row; uses only what the catalog already knows."""
+    return {
+        'type': 'video',
+        'name': row['name'],
+        'url': url_for('files', filename=row['path']),
+        'thumb': url_for('files', filename=row['thumb'] or DEFAULT_VIDEO_THUMB),
+        **video_derivative_urls(row),
+        **media_metadata(row)
+    }
+
+# --- Video indexer ---
+# Fills in duration, dimensions, codec, bitrate and rotation for catalogued
+# videos with ffprobe, in the background. Results are cached on the media row
+# with the size and mtime they were read at, so each file is probed once per
+# change; cached_video_metadata serves other callers from the same cache.
+VIDEO_PROBE_TIMEOUT = 30
+VIDEO_METADATA_FIELDS = ('duration', 'width', 'height', 'codec', 'bitrate', 'rotation')
+_video_indexer_wakeup = threading.Event()
+_video_indexer_thread = None
+
+def probe_video(full_path):
+    """Read duration, dimensions, codec, bitrate and rotation with ffprobe. Returns {} on failure."""
+    try:
+        result = subprocess.run([
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', ('stream=codec_name,width,height,bit_rate:stream_tags=rotate:'
+                              'stream_side_data=rotation:format=duration,bit_rate'),
+            '-of', 'json',
+            full_path
+        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=VIDEO_PROBE_TIMEOUT)
+        info = json.loads(result.stdout or b'{}')
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError, ValueError) as e:
+        print(f"Error probing {full_path}: {e}")
+        return {}
+    stream = (info.get('streams') or [{}])[0]
+    duration = info.get('format', {}).get('duration')
+    bitrate = info.get('format', {}).get('bit_rate') or stream.get('bit_rate')
+    # Older files carry a 'rotate' tag; newer ffprobe reports a display matrix
+    # rotation, which is counter-clockwise
+    rotation = stream.get('tags', {}).get('rotate')
+    if rotation is None:
+        side_rotation = next((d['rotation'] for d in stream.get('side_data_list', []) if 'rotation' in d), None)
+        rotation = -int(side_rotation) if side_rotation is not None else 0
+    return {
+        'duration': float(duration) if duration else None,
+        'width': stream.get('width'),
+        'height': stream.get('height'),
+        'codec': stream.get('codec_name'),
+        'bitrate': int(bitrate) if bitrate else None,
+        'rotation': int(rotation) % 360
+    }
+
+def store_video_metadata(db, path, mtime, size, meta):
+    """Cache probe results on a media row, keyed by the file's mtime and size. The caller commits."""
+    db.execute("""UPDATE media SET duration = ?, width = ?, height = ?, codec = ?, bitrate = ?, rotation = ?,
+                  probed_mtime = ?, probed_size = ? WHERE path = ?""",
+               tuple(meta.get(field) for field in VIDEO_METADATA_FIELDS) + (mtime, size, path))
+
+def cached_video_metadata(db, path):
+    """
+    Metadata for a video, probing (and caching it) only if the file changed since
+    the last probe. A fresh probe is committed straight away, since callers go on
+    to run ffmpeg and must not hold the write lock meanwhile.
+    """
+    full_path = os.path.join(BASE_DIR, path)
+    st = os.stat(full_path)
+    row = db.execute('SELECT * FROM media WHERE path = ?', (path,)).fetchone()
+    if row is not None and row['probed_mtime'] == st.st_mtime and row['probed_size'] == st.st_size:
+        return {field: row[field] for field in VIDEO_METADATA_FIELDS}
+    meta = probe_video(full_path)
+    if row is not None:
+        store_video_metadata(db, path, st.st_mtime, st.st_size, meta)
+        db.commit()
+    return meta
+
+def media_metadata(row):
+    """Intrinsic metadata fields and placeholder for a media payload item, from its catalog row."""
+    if row is None:
+        return {}
+    if row['type'] == 'image':
+        return {'width': row['width'], 'height': row['height'], 'lqip': row['lqip']}
+    return dict({field: row[field] for field in VIDEO_METADATA_FIELDS}, lqip=row['lqip'])
+
+def _video_indexer_loop():
+    while True:
+        _video_indexer_wakeup.wait(60)
+        _video_indexer_wakeup.clear()
+        db = connect_db()
+        try:
+            while True:
+                rows = db.execute("""SELECT id, path, mtime, size FROM media WHERE type = 'video'
+                                     AND (probed_mtime IS NOT mtime OR probed_size IS NOT size) LIMIT 50""").fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    # Committed per video: no write transaction stays open across ffprobe
+                    meta = probe_video(os.path.join(BASE_DIR, row['path']))
+                    store_video_metadata(db, row['path'], row['mtime'], row['size'], meta)
+                    if needs_faststart(row['path']):
+                        db.commit()
+                        continue  # probed again and queued from the remuxed file
+                    # A web container holding e.g. HEVC or MPEG-4 Part 2 only shows up once probed
+                    if (meta.get('codec') and needs_transcode(row['path'], meta['codec'])
+                            and not needs_transcode(row['path'])):
+                        enqueue_job(db, 'transcode', row['path'], row['mtime'])
+                    if meta.get('duration'):
+                        enqueue_job(db, 'sprites', row['path'], row['mtime'])
+                        enqueue_job(db, 'preview', row['path'], row['mtime'])
+                    if wants_hls(meta.get('duration')):
+                        enqueue_job(db, 'hls', row['path'], row['mtime'])
+                    db.commit()
+        except Exception as e:
+            print(f"Video indexer: {e}")
+        finally:
+            db.close()
+
+def start_video_indexer():
+    global _video_indexer_thread
+    if _video_indexer_thread is not None:
+        return
+    _video_indexer_thread = threading.Thread(target=_video_indexer_loop, name='video-indexer', daemon=True)
+    _video_indexer_thread.start()
+    _video_indexer_wakeup.set()
+
+# --- Background jobs ---
+# Slow media work (ffmpeg) runs on a small pool of worker threads fed by the
+# persistent `jobs` table, so requests only ever enqueue. JOB_WORKERS bounds how
+# many ffmpeg processes run at once; handlers are looked up by job kind.
+# Failed jobs are kept with their error and retried with exponential backoff
+# (JOB_RETRY_BASE, doubling up to JOB_RETRY_MAX seconds), or straight away once
+# the source file changes.
+# Queued jobs run highest priority first (uploads outrank background catch-up),
+# and at most HEAVY_JOB_WORKERS workers run long jobs such as transcodes at
+# once, so thumbnails keep flowing while a big file converts.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+HEAVY_JOB_WORKERS = int(os.environ.get('HEAVY_JOB_WORKERS', 1))
+HEAVY_JOB_KINDS = ('transcode', 'faststart', 'hls', 'sprites')
+JOB_POLL_INTERVAL = 2  # workers also re-check this often, in case a wakeup came before the commit
+JOB_RETRY_BASE = 60
+JOB_RETRY_MAX = 24 * 3600
+UPLOAD_JOB_PRIORITY = 10
+_job_wakeup = threading.Event()
+_job_threads = []
+_heavy_job_slots = threading.BoundedSemaphore(max(1, HEAVY_JOB_WORKERS))
+
+def enqueue_job(db, kind, path, source_mtime=None, priority=0):
+    """
+    Queue a job unless the same one is already queued or running, or it failed
+    and is still backing off on an unchanged file. A queued job is raised to
+    `priority` if that is higher. The caller commits.
+    """
+    if source_mtime is None:
+        try:
+            source_mtime = os.stat(os.path.join(BASE_DIR, path)).st_mtime
+        except OSError:
+            return
+    db.execute("""INSERT INTO jobs (kind, path, status, created, source_mtime, priority)
+                  VALUES (?, ?, 'queued', ?, ?, ?)
+                  ON CONFLICT(kind, path) DO UPDATE SET
+                      status = 'queued', error = NULL, created = excluded.created, priority = excluded.priority,
+                      attempts = CASE WHEN jobs.source_mtime IS excluded.source_mtime THEN jobs.attempts ELSE 0 END,
+                      source_mtime = excluded.source_mtime
+                  WHERE jobs.status = 'done'
+                     OR (jobs.status = 'failed' AND (jobs.source_mtime IS NOT excluded.source_mtime
+                                                     OR jobs.next_retry <= excluded.created))""",
+               (kind, path, time.time(), source_mtime, priority))
+    if priority:
+        db.execute("UPDATE jobs SET priority = ? WHERE kind = ? AND path = ? AND status = 'queued' AND priority < ?",
+                   (priority, kind, path, priority))
+    _job_wakeup.set()
+
+def _claim_job(db, heavy=True):
+    """
+    Atomically take the next queued job (safe across threads and processes):
+    highest priority, then oldest. With heavy=False, HEAVY_JOB_KINDS are skipped.
+    """
+    query = "SELECT id, kind, path FROM jobs WHERE status = 'queued'"
+    if not heavy:
+        query += ' AND kind NOT IN (%s)' % ','.join('?' * len(HEAVY_JOB_KINDS))
+    params = () if heavy else HEAVY_JOB_KINDS
+    while True:
+        row = db.execute(query + ' ORDER BY priority DESC, id LIMIT 1', params).fetchone()
+        if row is None:
+            return None
+        cur = db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ? AND status = 'queued'",
+                         (time.time(), row['id']))
+        db.commit()
+        if cur.rowcount == 1:
+            return row
+
+def _run_thumbnail_job(db, path):
+    if not os.path.exists(os.path.join(BASE_DIR, path)):
+        return
+    source = content_hash_for(db, path)
+    full_thumb_path = os.path.join(BASE_DIR, thumb_path_for(source[0]))
+    parked = os.path.join(BASE_DIR, legacy_thumb_path_for(path))
+    if os.path.exists(parked):
+        # A sidecar from before the store: file it under the hash if it was made from this version
+        if not os.path.exists(full_thumb_path) and os.path.getmtime(parked) >= source[1].st_mtime:
+            os.makedirs(os.path.dirname(full_thumb_path), exist_ok=True)
+            os.replace(parked, full_thumb_path)
+        else:
+            os.remove(parked)
+    if not os.path.exists(full_thumb_path):
+        duration = cached_video_metadata(db, path).get('duration')
+        extract_video_thumbnail(path, source, THUMB_JOB_TIMEOUT, duration)
+    store_thumbnail(db, source[0])
+
+def store_video_output(db, column, content_hash, output_path):
+    """Point every catalogued copy of a video at an output just made, and account it. The caller commits."""
+    if output_path is None or not os.path.exists(os.path.join(BASE_DIR, output_path)):
+        return  # thrown away because the video changed
+    db.execute(f'UPDATE media SET {column} = ? WHERE content_hash = ?', (output_path, content_hash))
+    record_derivative(db, output_path)
+
+def _run_lqip_job(db, path):
+    """Placeholder for a video, made from its thumbnail."""
+    row = db.execute('SELECT thumb FROM media WHERE path = ?', (path,)).fetchone()
+    if row is None or row['thumb'] is None:
+        return  # the thumbnail job queues us again once there is one
+    full_thumb_path = os.path.join(BASE_DIR, row['thumb'])
+    if not os.path.exists(full_thumb_path):
+        return
+    lqip = make_lqip(full_thumb_path, THUMB_JOB_TIMEOUT)
+    db.execute('UPDATE media SET lqip = ? WHERE path = ? AND thumb = ?', (lqip, path, row['thumb']))
+
+def _run_derivatives_job(db, path):
+    if not os.path.exists(os.path.join(BASE_DIR, path)):
+        return
+    source = content_hash_for(db, path)
+    store_image_derivatives(db, path, source[1].st_mtime, build_image_derivatives(path, source, THUMB_JOB_TIMEOUT))
+
+def _run_image_variant_job(db, path, fmt):
+    """`path` is an uploaded image or one of its derivatives in the store."""
+    full_path = os.path.join(BASE_DIR, path)
+    if not os.path.exists(full_path):
+        return
+    parsed = parse_store_path(path)
+    source = content_hash_for(db, path) if parsed is None else (parsed[0], os.stat(full_path))
+    record_derivative(db, generate_image_variant(path, fmt, source, THUMB_JOB_TIMEOUT))
+
+def _run_faststart_job(db, path):
+    if not os.path.exists(os.path.join(BASE_DIR, path)):
+        return
+    job = db.execute("SELECT priority FROM jobs WHERE kind = 'faststart' AND path = ?", (path,)).fetchone()
+    priority = job['priority'] if job is not None else 0
+    if faststart_remux(path, TRANSCODE_TIMEOUT):
+        catalog_sync_path(db, path, priority=priority)
+    else:
+        # Nothing to move after all: queue the jobs catalog_upsert held back
+        _catalog_sync_file(db, path, priority)
+
+def _run_hls_job(db, path):
+    if not os.path.exists(os.path.join(BASE_DIR, path)):
+        return
+    source = content_hash_for(db, path)
+    meta = cached_video_metadata(db, path)
+    if not meta.get('height'):
+        raise RuntimeError('could not read video dimensions')
+    # ffmpeg encodes the frame the way it is displayed
+    width, height = display_size(meta)
+    store_video_output(db, 'stream', source[0], package_hls(path, source, width, height, TRANSCODE_TIMEOUT))
+
+def _run_sprites_job(db, path):
+    if not os.path.exists(os.path.join(BASE_DIR, path)):
+        return
+    source = content_hash_for(db, path)
+    meta = cached_video_metadata(db, path)
+    if not meta.get('duration') or not meta.get('width'):
+        raise RuntimeError('could not read video duration and dimensions')
+    store_video_output(db, 'sprites', source[0], generate_sprites(path, source, meta, TRANSCODE_TIMEOUT))
+
+def _run_preview_job(db, path):
+    if not os.path.exists(os.path.join(BASE_DIR, path)):
+        return
+    source = content_hash_for(db, path)
+    duration = cached_video_metadata(db, path).get('duration')
+    if not duration:
+        raise RuntimeError('could not read video duration')
+    store_video_output(db, 'preview', source[0], generate_preview_clip(path, source, duration, THUMB_JOB_TIMEOUT))
+
+def _run_transcode_job(db, path):
+    if not os.path.exists(os.path.join(BASE_DIR, path)):
+        return
+    source = content_hash_for(db, path)
+    store_video_output(db, 'playable', source[0], transcode_video(path, source, TRANSCODE_TIMEOUT))
+
+JOB_HANDLERS = {
+    'thumbnail': _run_thumbnail_job,
+    'transcode': _run_transcode_job,
+    'faststart': _run_faststart_job,
+    'hls': _run_hls_job,
+    'sprites': _run_sprites_job,
+    'preview': _run_preview_job,
+    'derivatives': _run_derivatives_job,
+    'lqip': _run_lqip_job,
+    'avif': lambda db, path: _run_image_variant_job(db, path, 'avif'),
+    'webp': lambda db, path: _run_image_variant_job(db, path, 'webp'),
+}
+
+def _job_worker_loop():
+    db = connect_db()
+    while True:
+        heavy = _heavy_job_slots.acquire(blocking=False)
+        try:
+            job = _claim_job(db, heavy)
+        except sqlite3.OperationalError as e:
+            print(f"Job worker: {e}")
+            job = None
+        if heavy and (job is None or job['kind'] not in HEAVY_JOB_KINDS):
+            _heavy_job_slots.release()
+            heavy = False
+        if job is None:
+            _job_wakeup.wait(JOB_POLL_INTERVAL)
+            _job_wakeup.clear()
+            continue
+        try:
+            JOB_HANDLERS[job['kind']](db, job['path'])
+            db.execute("UPDATE jobs SET status = 'done', finished = ? WHERE id = ?", (time.time(), job['id']))
+        except Exception as e:
+            print(f"Job {job['kind']} failed for {job['path']}: {e}")
+            db.rollback()
+            error = str(e)
+            if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+                error = e.stderr.decode('utf-8', 'replace').strip() or error
+            now = time.time()
+            db.execute("""UPDATE jobs SET status = 'failed', error = ?, finished = ?, attempts = attempts + 1,
+                                           next_retry = ? + min(?, ? * (1 << min(attempts, 20)))
+                          WHERE id = ?""",
+                       (error[-1000:], now, now, JOB_RETRY_MAX, JOB_RETRY_BASE, job['id']))
+        finally:
+            if heavy:
+                _heavy_job_slots.release()
+        db.commit()
+
+def start_job_workers():
+    if _job_threads:
+        return
+    db = connect_db()
+    try:
+        # Only the background leader runs jobs, and it has only just started, so
+        # anything still marked running was left by a leader that died
+        cur = db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        db.commit()
+        if cur.rowcount:
+            print(f"Requeued {cur.rowcount} jobs left running by a previous process")
+    finally:
+        db.close()
+    for i in range(JOB_WORKERS):
+        thread = threading.Thread(target=_job_worker_loop, name=f'job-worker-{i}', daemon=True)
+        thread.start()
+        _job_threads.append(thread)
+
+@app.route('/api/admin/job_failures')
+def api_job_failures():
+    """Failed jobs (e.g. broken videos ffmpeg can't thumbnail), most-attempted first."""
+    kind = request.args.get('kind')
+    query = 'SELECT kind, path, error, attempts, source_mtime, finished, next_retry FROM jobs WHERE status = ?'
+    params = ['failed']
+    if kind:
+        query += ' AND kind = ?'
+        params.append(kind)
+    rows = get_db().execute(query + ' ORDER BY attempts DESC, finished DESC', params).fetchall()
+    return jsonify({'failures': [dict(row) for row in rows]})
+
+@app.route('/api/thumbnail')
+def api_thumbnail():
+    """Thumbnail status for a video (path relative to /files/), for clients polling a pending thumb."""
+    path = (request.args.get('path') or '').lstrip('/')
+    if path.startswith('files/'):
+        path = path[len('files/'):]
+    if not path or not is_video(path):
+        return jsonify({'error': 'A video path is required'}), 400
+    media = get_db().execute('SELECT thumb FROM media WHERE path = ?', (path,)).fetchone()
+    if media is not None and media['thumb']:
+        return jsonify({'status': 'done', 'thumb': url_for('files', filename=media['thumb'])})
+    row = get_db().execute("SELECT status, error FROM jobs WHERE kind = 'thumbnail' AND path = ?", (path,)).fetchone()
+    return jsonify({
+        'status': row['status'] if row else 'missing',
+        'thumb': url_for('files', filename=DEFAULT_VIDEO_THUMB)
+    })
+
+@app.route('/api/admin/catalog/reconcile', methods=['POST'])
+def api_reconcile_catalog():
+    try:
+        return jsonify({'success': True, **reconcile_media_catalog()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 # --- API Endpoints for Pagination ---
+@app.route('/api/gallery')
+def api_gallery():
+    try:
+        path = request.args.get('path')
+        depth = request.args.get('depth')
+        if depth:
+            if not depth.isdigit() or int(depth) < 1:
+                return jsonify({'error': 'depth must be a positive integer'}), 400
+            depth = int(depth)
+        return jsonify(get_gallery_structure(path, depth or None))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/interfaith')
 def api_interfaith():
     offset = int(request.args.get('offset', 0))
     limit = int(request.args.get('limit', 30))
-    all_media = get_interfaith_media()
-    paged = all_media[offset:offset + limit]
+    rows = get_db().execute(
+        "SELECT * FROM media WHERE root = 'interfaith' ORDER BY name LIMIT ? OFFSET ?",
+        (limit, offset)).fetchall()
+    paged = [media_row_to_item(row) for row in rows]
     print(f"/api/interfaith: Serving items {offset} to {offset + limit} (got {len(paged)})")
     return jsonify(paged)
 
 @app.route('/api/tiktok')
 def api_tiktok():
-    offset = int(request.args.get('offset', 0))
-    limit = int(request.args.get('limit', 15))
-    all_videos = get_all_videos()
-    paged = all_videos[offset:offset + limit]
-    print(f"/api/tiktok: Serving videos {offset} to {offset + limit} (got {len(paged)})")
-    return jsonify(paged)
+    # Served entirely from the video index: a seeded shuffle paged by cursor, no directory I/O
+    try:
+        limit = int(request.args.get('limit', 15))
+        rows, next_cursor = seeded_page(
+            get_db(), "type = 'video' AND root IN (?, ?, ?)", TIKTOK_ROOTS, request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    paged = [video_row_to_item(row) for row in rows]
+    print(f"/api/tiktok: Serving {len(paged)} videos")
+    return jsonify({'items': paged, 'cursor': next_cursor})
 
 # --- API Endpoints ---
-def get_all_media_recursive(user, tab, base_path=""):
-    """Recursively get all media from a tab including subdirectories"""
-    media = []
-    if base_path:
-        tab_path = os.path.join(USERS_DIR, user, tab, base_path)
-    else:
-        tab_path = os.path.join(USERS_DIR, user, tab)
-    
-    if not os.path.exists(tab_path):
-        return media
-    
+# --- Feed pagination ---
+# The feed is a seeded, stable shuffle of the catalog. Each session gets a random
+# seed and the catalog's id high-water mark when it starts; pages walk a keyed
+# pseudo-random permutation of that id range, skipping ids that are gone or do
+# not match, so pages never repeat or skip. The seed, position and bound travel
+# in an opaque cursor, so any process can serve the next page without a cache.
+SEEDED_PAGE_MAX_SCAN = 5000  # permutation positions tried per request; a sparse match returns a short page
+
+def media_id_bound(db):
+    """One past the highest media id ever assigned (AUTOINCREMENT ids are never reused)."""
+    row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'media'").fetchone()
+    return row[0] + 1 if row is not None else 1
+
+def permute_index(index, n, seed, rounds=4):
+    """
+    Keyed pseudo-random permutation of range(n): a balanced Feistel network over
+    the smallest even-bit power of two >= n, with cycle walking to stay in range.
+    """
+    if n <= 1:
+        return index
+    half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    key = seed.to_bytes(8, 'big')
+    value = index
+    while True:
+        left, right = value >> half_bits, value & mask
+        for r in range(rounds):
+            digest = hashlib.blake2b(right.to_bytes(8, 'big'), digest_size=8, key=key,
+                                     salt=r.to_bytes(16, 'big')).digest()
+            left, right = right, left ^ (int.from_bytes(digest, 'big') & mask)
+        value = (left << half_bits) | right
+        if value < n:
+            return value
+
+def encode_cursor(state):
+    raw = json.dumps(state, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
     try:
-        for entry in os.listdir(tab_path):
-            if entry.endswith('_thumb.jpg'):
-                continue
-            full_path = os.path.join(tab_path, entry)
-            if base_path:
-                rel_entry = os.path.join(tab, base_path, entry).replace('\\', '/')
-            else:
-                rel_entry = os.path.join(tab, entry).replace('\\', '/')
-            
-            if os.path.isdir(full_path):
-                # Recursively get media from subdirectory
-                sub_path = os.path.join(base_path, entry) if base_path else entry
-                media.extend(get_all_media_recursive(user, tab, sub_path))
-            elif is_image(entry):
-                url = url_for('files', filename=os.path.join('users', user, rel_entry).replace('\\', '/'))
-                media.append({'type': 'image', 'name': entry, 'url': url})
-            elif is_video(entry):
-                url = url_for('files', filename=os.path.join('users', user, rel_entry).replace('\\', '/'))
-                thumb = get_video_thumbnail_local(os.path.join('users', user, rel_entry).replace('\\', '/'))
-                media.append({'type': 'video', 'name': entry, 'url': url, 'thumb': thumb})
-    except Exception as e:
-        print(f"Error reading directory {tab_path}: {e}")
-    
-    return media
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(raw)
+        seed, offset, bound = int(state['s']), int(state['o']), int(state['b'])
+    except (ValueError, KeyError, TypeError):
+        return None
+    # permute_index keys on 8 bytes of seed; anything else is a forged cursor
+    if not 0 <= seed < 2 ** 64 or offset < 0 or bound < 1:
+        return None
+    return seed, offset, bound
+
+def catalog_rows(db, paths):
+    """Map each catalogued path in `paths` to its media row, in one query."""
+    if not paths:
+        return {}
+    rows = db.execute('SELECT * FROM media WHERE path IN (%s)' % ','.join('?' * len(paths)), list(paths))
+    return {row['path']: row for row in rows}
+
+def fetch_media_rows(db, ids):
+    """Fetch catalog rows for a list of ids, in the given order (missing ids are dropped)."""
+    if not ids:
+        return []
+    rows = db.execute('SELECT * FROM media WHERE id IN (%s)' % ','.join('?' * len(ids)), ids)
+    by_id = {row['id']: row for row in rows}
+    return [by_id[i] for i in ids if i in by_id]
+
+def seeded_page(db, where, params, cursor, limit):
+    """
+    Resolve a cursor (or start a new session) and return (rows, next_cursor) for
+    one page of a seeded shuffle over the media rows matching `where`.
+    """
+    if limit < 0:
+        raise ValueError('limit must not be negative')
+    current_bound = media_id_bound(db)
+    state = decode_cursor(cursor) if cursor else None
+    if state is not None and state[2] > current_bound:
+        state = None  # ids that were never handed out: forged
+    if state is None:
+        seed, position, bound = random.getrandbits(63), int(request.args.get('offset', 0)), current_bound
+        if position < 0:
+            raise ValueError('offset must not be negative')
+    else:
+        seed, position, bound = state
+    page_ids = []
+    scan_end = min(bound, position + SEEDED_PAGE_MAX_SCAN)
+    while len(page_ids) < limit and position < scan_end:
+        chunk_end = min(scan_end, position + max(2 * limit, 64))
+        candidates = [permute_index(i, bound, seed) for i in range(position, chunk_end)]
+        present = {row[0] for row in db.execute(
+            'SELECT id FROM media WHERE id IN (%s) AND (%s)' % (','.join('?' * len(candidates)), where),
+            candidates + list(params))}
+        for candidate in candidates:
+            position += 1
+            if candidate in present:
+                page_ids.append(candidate)
+                if len(page_ids) == limit:
+                    break
+    next_cursor = encode_cursor({'s': seed, 'o': position, 'b': bound}) if position < bound else None
+    return fetch_media_rows(db, page_ids), next_cursor
 
 @app.route('/api/feed')
 def api_feed():
     try:
-        offset = int(request.args.get('offset', 0))
         limit = int(request.args.get('limit', 30))
-        users = list_users()
+        rows, next_cursor = seeded_page(
+            get_db(), 'root IN (?, ?, ?)', FEED_ROOTS, request.args.get('cursor'), limit)
         feed = []
-        for user in users:
-            tabs = list_tabs(user)
-            for tab in tabs:
-                # Get all media recursively from tab and subdirectories
-                media = get_all_media_recursive(user, tab)
-                for item in media:
-                    if item['type'] in ('image', 'video'):
-                        item['user'] = user
-                        item['tab'] = tab
-                        feed.append(item)
-        # Add interfaith media
-        for item in get_interfaith_media():
-            if item['type'] in ('image', 'video'):
-                item['user'] = 'interfaith'
-                item['tab'] = 'interfaith'
-                feed.append(item)
-        # Add videos and images from the root videos directory
-        if os.path.exists(VIDEOS_DIR):
-            for item in os.listdir(VIDEOS_DIR):
-                if item.endswith('_thumb.jpg'):
-                    continue
-                if is_video(item):
-                    local_rel = os.path.join('videos', item).replace('\\', '/')
-                    url = url_for('files', filename=local_rel)
-                    thumb = get_video_thumbnail_local(local_rel)
-                    feed.append({'type': 'video', 'name': item, 'url': url, 'thumb': thumb, 'user': 'videos', 'tab': 'videos'})
-                elif is_image(item):
-                    local_rel = os.path.join('videos', item).replace('\\', '/')
-                    url = url_for('files', filename=local_rel)
-                    feed.append({'type': 'image', 'name': item, 'url': url, 'user': 'videos', 'tab': 'videos'})
-        import random
-        random.shuffle(feed)
-        feed = feed[offset:offset+limit]
-        return jsonify(feed)
+        for row in rows:
+            item = media_row_to_item(row)
+            item['user'] = row['user']
+            item['tab'] = row['tab']
+            feed.append(item)
+        return jsonify({'items': feed, 'cursor': next_cursor})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -578,35 +2730,23 @@ def api_stories():
 
 @app.route('/api/profile/<username>')
 def api_profile(username):
-    tabs = list_tabs(username)
+    db = get_db()
+    summaries = {row['tab']: row for row in db.execute('SELECT * FROM tab_summary WHERE user = ?', (username,))}
     tab_info = []
-    for tab in tabs:
-        tab_path = os.path.join(USERS_DIR, username, tab)
-        story_json_path = os.path.join(tab_path, 'story.json')
-        if os.path.exists(story_json_path):
-            tab_type = 'story'
-        else:
-            tab_type = detect_tab_type(tab_path)
-        media_count = 0
-        try:
-            for entry in os.listdir(tab_path):
-                if entry.endswith('_thumb.jpg'):
-                    continue
-                full_path = os.path.join(tab_path, entry)
-                if os.path.isdir(full_path):
-                    for root, dirs, files in os.walk(full_path):
-                        for file in files:
-                            if not file.endswith('_thumb.jpg'):
-                                media_count += 1
-                elif is_image(entry) or is_video(entry):
-                    media_count += 1
-        except Exception as e:
-            print(f"Error counting media in {tab_path}: {e}")
-            media_count = 0
+    for tab in list_tabs(username):
+        summary = summaries.get(tab)
+        if summary is None:
+            # Tab created since the last catalog update
+            summary = refresh_tab_summary(db, username, tab)
+            db.commit()
         tab_info.append({
             'name': tab,
-            'type': tab_type,
-            'count': media_count
+            'type': summary['tab_type'],
+            'count': summary['media_count'],
+            'images': summary['image_count'],
+            'videos': summary['video_count'],
+            'albums': summary['album_count'],
+            'bytes': summary['total_bytes']
         })
     return jsonify({'username': username, 'tabs': tab_info})
 
@@ -632,6 +2772,9 @@ def api_add_tab(username):
         }
         with open(os.path.join(tab_dir, 'story.json'), 'w', encoding='utf-8') as f:
             json.dump(story_json, f, indent=2)
+    db = get_db()
+    refresh_tab_summary(db, username, tab_name)
+    db.commit()
     # Optionally, create subfolders for albums (media tabs only)
     return jsonify({'success': True, 'tab': tab_name, 'type': tab_type})
 
@@ -663,6 +2806,15 @@ def api_upload_to_tab(username, tab):
                     file_path = os.path.join(target_dir, filename)
                     file.save(file_path)
                     uploaded_files.append(filename)
+            # Catalogued once everything is on disk, so no transaction is open while files are written
+            db = get_db()
+            target_rel = os.path.relpath(target_dir, BASE_DIR).replace('\\', '/')
+            for filename in uploaded_files:
+                catalog_sync_path(db, target_rel + '/' + filename, priority=UPLOAD_JOB_PRIORITY, refresh=False)
+            if uploaded_files:
+                refresh_summaries_for_path(db, target_rel)
+                invalidate_album_covers(db, target_rel)
+            db.commit()
             
             target_location = f"album '{album_path}'" if album_path else "tab root"
             return jsonify({
@@ -679,6 +2831,9 @@ def api_upload_to_tab(username, tab):
             folder_path = os.path.join(target_dir, folder_name)
             if not os.path.exists(folder_path):
                 os.makedirs(folder_path)
+                db = get_db()
+                catalog_sync_path(db, os.path.relpath(folder_path, BASE_DIR))
+                db.commit()
                 return jsonify({
                     'success': True,
                     'message': f'Created folder: {folder_name}',
@@ -701,14 +2856,17 @@ def api_list_tab_files(username, tab):
             return jsonify({'error': 'Tab does not exist'}), 404
         
         files = []
-        for entry in os.listdir(tab_dir):
-            if entry.endswith('_thumb.jpg'):
-                continue
-            full_path = os.path.join(tab_dir, entry)
+        for entry in walk_media(tab_dir, recursive=False):
+            size = None
+            if entry.kind != 'dir':
+                try:
+                    size = entry.entry.stat().st_size
+                except OSError:
+                    pass  # e.g. a dangling symlink
             file_info = {
-                'name': entry,
-                'type': 'folder' if os.path.isdir(full_path) else 'file',
-                'size': os.path.getsize(full_path) if os.path.isfile(full_path) else None
+                'name': entry.name,
+                'type': 'folder' if entry.kind == 'dir' else 'file',
+                'size': size
             }
             files.append(file_info)
         
@@ -723,7 +2881,7 @@ def api_profile_tab_media(username, tab):
         offset = int(request.args.get('offset', 0))
         limit = int(request.args.get('limit', 30))
         rel_path = request.args.get('rel_path')
-        items = get_tab_media_paged(username, tab, rel_path, offset, limit)
+        items = get_tab_media_paged(username, tab, rel_path, offset, limit, media_shuffle_seed())
         return jsonify(items)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -734,7 +2892,7 @@ def api_profile_album(username, tab):
         album = request.args.get('album')
         offset = int(request.args.get('offset', 0))
         limit = int(request.args.get('limit', 30))
-        items = get_tab_media_paged(username, tab, album, offset, limit)
+        items = get_tab_media_paged(username, tab, album, offset, limit, media_shuffle_seed())
         return jsonify(items)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -760,6 +2918,9 @@ def api_delete_album(username, tab):
         # Delete the entire directory and its contents
         import shutil
         shutil.rmtree(full_path)
+        db = get_db()
+        catalog_sync_path(db, os.path.relpath(full_path, BASE_DIR))
+        db.commit()
         
         return jsonify({'success': True, 'message': f'Album "{album_path}" deleted successfully'})
         
@@ -784,24 +2945,290 @@ def api_delete_media(username, tab):
         if os.path.isdir(full_path):
             return jsonify({'error': 'Path is a directory, not a media file'}), 400
         
-        # Delete the media file
+        # Delete the media file; its derivatives age out of the store (identical files may share them)
         os.remove(full_path)
-        
-        # Also delete thumbnail if it exists (for videos)
-        base, ext = os.path.splitext(full_path)
-        thumb_path = base + "_thumb.jpg"
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
+        db = get_db()
+        catalog_sync_path(db, os.path.relpath(full_path, BASE_DIR))
+        db.commit()
         
         return jsonify({'success': True, 'message': f'Media "{media_path}" deleted successfully'})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# --- Media responses ---
+# /files and /hls stream files themselves instead of using send_from_directory:
+# strong ETags from (inode, size, mtime), 304s for If-None-Match and
+# If-Modified-Since, single and multi-range 206s (honouring If-Range) so players
+# can seek, and bodies handed to the server's wsgi.file_wrapper so servers that
+# support it (gunicorn) send them with sendfile. Store outputs are
+# content-addressed and cached as immutable; originals can change in place
+# (faststart remuxing, re-uploads) and are revalidated after MEDIA_CACHE_MAX_AGE.
+MEDIA_CACHE_MAX_AGE = int(os.environ.get('MEDIA_CACHE_MAX_AGE', 3600))
+IMMUTABLE_CACHE_MAX_AGE = 365 * 24 * 3600
+MAX_BYTE_RANGES = 16  # more than this (after merging) get the whole file
+MEDIA_BUFFER_SIZE = 256 * 1024
+# With MEDIA_OFFLOAD=nginx the app only resolves and authorizes the file and
+# answers with an X-Accel-Redirect to MEDIA_OFFLOAD_PREFIX + path, an internal
+# nginx location aliased to the app directory (see deploy/nginx-media.conf);
+# with MEDIA_OFFLOAD=sendfile it answers with X-Sendfile and the absolute path
+# (Apache mod_xsendfile, lighttpd). The proxy then streams the file and handles
+# Range and conditional requests, so no worker is tied up per viewer.
+MEDIA_OFFLOAD = os.environ.get('MEDIA_OFFLOAD', 'off')
+if MEDIA_OFFLOAD not in ('off', 'nginx', 'sendfile'):
+    print(f"Unknown MEDIA_OFFLOAD {MEDIA_OFFLOAD!r}, serving media from the app")
+    MEDIA_OFFLOAD = 'off'
+MEDIA_OFFLOAD_PREFIX = os.environ.get('MEDIA_OFFLOAD_PREFIX', '/_media/')
+# Top-level entries of BASE_DIR that /files may serve from
+SERVED_MEDIA_TOPS = {name for name, _ in MEDIA_ROOTS} | {'.derivatives', DEFAULT_VIDEO_THUMB}
+_BYTE_RANGE_RE = re.compile(r'\s*(\d*)\s*-\s*(\d*)\s*$')
+
+def media_etag(st):
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def parse_byte_ranges(header, size):
+    """
+    Byte ranges asked for by a Range header, as sorted and merged (start, stop)
+    pairs. Returns None if the header is to be ignored (absent, malformed, not
+    bytes, or too many ranges) and [] if none of the ranges can be satisfied.
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header.split('=', 1)[1].split(','):
+        match = _BYTE_RANGE_RE.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            stop = min(int(last) + 1, size) if last else size
+        elif last:
+            start, stop = max(size - int(last), 0), size  # suffix range: the final N bytes
+        else:
+            return None
+        if start < stop:
+            ranges.append((start, stop))
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return None if len(merged) > MAX_BYTE_RANGES else merged
+
+def _not_modified(st, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # Weak comparison; If-Modified-Since is ignored when If-None-Match is sent
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    since = request.if_modified_since
+    return since is not None and int(st.st_mtime) <= since.timestamp()
+
+def _if_range_allows(st, etag):
+    """False if an If-Range validator no longer matches, i.e. the whole file must be sent."""
+    value = request.headers.get('If-Range', '').strip()
+    if not value:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag  # strong comparison
+    date = parse_date(value)
+    return date is not None and date.timestamp() == int(st.st_mtime)
+
+class _FileSlice:
+    """
+    The next `length` bytes of an open file, for wsgi.file_wrapper. Servers
+    that sendfile() from fileno() are bounded by Content-Length; read() stops at
+    the end of the slice for the rest.
+    """
+    def __init__(self, f, length):
+        self._file = f
+        self._remaining = length
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+def _read_ranges(f, parts, trailer):
+    for head, start, stop in parts:
+        yield head
+        f.seek(start)
+        remaining = stop - start
+        while remaining:
+            chunk = f.read(min(remaining, MEDIA_BUFFER_SIZE))
+            if not chunk:
+                return  # truncated under us; the client sees a short body
+            remaining -= len(chunk)
+            yield chunk
+    yield trailer
+
+def resolve_media_path(rel_path):
+    """
+    Full path of a file /files may serve, or None. It has to be a regular file
+    in a media root, the derivative store or the default thumbnail, and stay
+    inside that entry once symlinks are resolved (the roots themselves may be
+    symlinks, e.g. to another disk). The database and app files never qualify.
+    """
+    full_path = safe_join(BASE_DIR, rel_path)
+    top = rel_path.split('/', 1)[0]
+    if full_path is None or top not in SERVED_MEDIA_TOPS:
+        return None
+    allowed = os.path.realpath(os.path.join(BASE_DIR, top))
+    real_path = os.path.realpath(full_path)
+    if real_path != allowed and not real_path.startswith(allowed + os.sep):
+        return None
+    return real_path if os.path.isfile(real_path) else None
+
+def offload_media(rel_path, full_path, mimetype, cache_control):
+    """Empty response telling the front proxy which file to stream (MEDIA_OFFLOAD)."""
+    response = Response(mimetype=mimetype, headers={'Cache-Control': cache_control})
+    if MEDIA_OFFLOAD == 'nginx':
+        response.headers['X-Accel-Redirect'] = MEDIA_OFFLOAD_PREFIX + quote(rel_path)
+    else:
+        response.headers['X-Sendfile'] = full_path
+    return response
+
+def send_media(rel_path, mimetype=None, immutable=False):
+    """Serve a file under BASE_DIR, answering conditional and Range requests."""
+    full_path = resolve_media_path(rel_path)
+    if full_path is None:
+        abort(404)
+    mimetype = mimetype or mimetypes.guess_type(rel_path)[0] or 'application/octet-stream'
+    cache_control = (f'public, max-age={IMMUTABLE_CACHE_MAX_AGE}, immutable' if immutable
+                     else f'public, max-age={MEDIA_CACHE_MAX_AGE}')
+    if MEDIA_OFFLOAD != 'off':
+        return offload_media(rel_path, full_path, mimetype, cache_control)
+    try:
+        f = open(full_path, 'rb')
+    except OSError:
+        abort(404)
+    try:
+        st = os.fstat(f.fileno())
+        etag = media_etag(st)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(st.st_mtime),
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': cache_control,
+        }
+        if _not_modified(st, etag):
+            f.close()
+            return Response(status=304, headers=headers)
+        ranges = parse_byte_ranges(request.headers.get('Range'), st.st_size) if _if_range_allows(st, etag) else None
+        if ranges == []:
+            f.close()
+            headers['Content-Range'] = f'bytes */{st.st_size}'
+            return Response(status=416, headers=headers)
+        if not ranges:
+            body, length = wrap_file(request.environ, f, MEDIA_BUFFER_SIZE), st.st_size
+            response = Response(body, status=200, headers=headers, mimetype=mimetype, direct_passthrough=True)
+        elif len(ranges) == 1:
+            start, stop = ranges[0]
+            f.seek(start)
+            body, length = wrap_file(request.environ, _FileSlice(f, stop - start), MEDIA_BUFFER_SIZE), stop - start
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{st.st_size}'
+            response = Response(body, status=206, headers=headers, mimetype=mimetype, direct_passthrough=True)
+        else:
+            boundary = os.urandom(12).hex()
+            parts = [(f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                      f'Content-Range: bytes {start}-{stop - 1}/{st.st_size}\r\n\r\n'.encode(), start, stop)
+                     for start, stop in ranges]
+            trailer = f'\r\n--{boundary}--\r\n'.encode()
+            length = sum(len(head) + stop - start for head, start, stop in parts) + len(trailer)
+            response = Response(_read_ranges(f, parts, trailer), status=206, headers=headers,
+                                content_type=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+            response.call_on_close(f.close)
+    except BaseException:
+        f.close()
+        raise
+    response.content_length = length
+    return response
+
 # --- Route to serve local files ---
+def negotiated_variant(filename):
+    """
+    Pick the best variant of an image the client accepts, queueing jobs for any
+    preferred variant that is missing once the request is done (see
+    queue_missing_variants). Returns (path, mimetype) or None.
+    """
+    full_path = safe_join(BASE_DIR, filename)
+    if full_path is None:
+        return None
+    try:
+        source = os.stat(full_path)
+    except OSError:
+        return None
+    parsed = parse_store_path(filename)
+    if parsed is not None:
+        content_hash = parsed[0]
+    else:
+        row = get_db().execute('SELECT content_hash, size, mtime FROM media WHERE path = ?', (filename,)).fetchone()
+        if row is None:
+            return None  # only catalogued uploads get variants
+        # Not hashed yet (or the catalog lags a change): the variant job hashes it
+        fresh = (row['size'], row['mtime']) == (source.st_size, source.st_mtime)
+        content_hash = row['content_hash'] if fresh else None
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    chosen = None
+    for fmt in IMAGE_VARIANT_FORMATS:
+        mimetype = IMAGE_VARIANTS[fmt][0]
+        if mimetype not in accepted:
+            continue
+        variant = None
+        if content_hash is not None:
+            variant_path = variant_path_for(filename, fmt, content_hash)
+            try:
+                variant = os.stat(os.path.join(BASE_DIR, variant_path))
+            except OSError:
+                pass
+        if variant is None:
+            g.setdefault('_pending_variants', set()).add((fmt, filename, source.st_mtime))
+        elif variant.st_size < source.st_size:
+            chosen = (variant_path, mimetype)
+            break
+    return chosen
+
+HLS_MIMETYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+@app.route('/hls/<path:filename>')
+def hls(filename):
+    """Serve HLS playlists and segments from the derivative store."""
+    mimetype = HLS_MIMETYPES.get(os.path.splitext(filename)[1])
+    parsed = parse_store_path('.derivatives/' + filename)
+    if mimetype is None or parsed is None or parsed[1] != 'hls':
+        abort(404)
+    if filename.endswith('/master.m3u8'):
+        # Playback counts as use for store eviction
+        touch_derivative('.derivatives/' + filename)
+    return send_media('.derivatives/' + filename, mimetype, immutable=True)
+
 @app.route('/files/<path:filename>')
 def files(filename):
-    return send_from_directory(BASE_DIR, filename)
+    # Store paths name their content, so they never change
+    immutable = parse_store_path(filename) is not None
+    if immutable:
+        touch_derivative(filename)
+    if not (IMAGE_VARIANT_FORMATS and can_vary_image(filename)):
+        return send_media(filename, immutable=immutable)
+    variant = negotiated_variant(filename)
+    if variant is None:
+        response = send_media(filename, immutable=immutable)
+    else:
+        response = send_media(variant[0], variant[1], immutable=immutable)
+    response.vary.add('Accept')
+    return response
 
 # --- Basic Login ---
 @app.route('/login', methods=['GET', 'POST'])
@@ -1078,6 +3505,7 @@ def home_page():
         .feed-badge { background: #2d88ff; color: #fff; font-size: 0.8em; border-radius: 6px; padding: 2px 8px; margin-left: 6px; }
         .feed-card img, .feed-card video {
           width: 100%;
+          height: auto;
           max-width: 480px;
           border-radius: 12px;
           background: #222;
@@ -1096,6 +3524,7 @@ def home_page():
           margin: 8px auto 0 auto;
         }
         .play-overlay { position: absolute; top: 50%; left: 50%; transform: translate(-50%,-50%); background: rgba(0,0,0,0.6); color: #fff; font-size: 2em; border-radius: 50%; padding: 8px 16px; pointer-events: none; }
+        .hover-preview { position: absolute; inset: 0; width: 100%; height: 100%; object-fit: cover; border-radius: inherit; pointer-events: none; }
         .feed-actions { display: flex; gap: 18px; margin-top: 10px; align-items: center; }
         .like-btn, .dislike-btn, .comment-btn { background: none; border: none; color: #aaa; font-size: 1.2em; cursor: pointer; display: flex; align-items: center; gap: 4px; border-radius: 6px; padding: 4px 8px; transition: background 0.15s, color 0.15s; }
         .like-btn.liked, .dislike-btn.disliked { color: #2d88ff; font-weight: bold; }
@@ -1341,7 +3770,7 @@ def home_page():
       <div id="modal-root"></div>
 
 <script>
-        let feedOffset = 0, FEED_BATCH = 20, feedEnd = false, feedLoading = false, feedCancelled = false;
+        let feedOffset = 0, feedCursor = null, FEED_BATCH = 20, feedEnd = false, feedLoading = false, feedCancelled = false;
         const feedList = document.getElementById('feed-list');
         const feedSpinner = document.getElementById('feed-spinner');
         const feedError = document.getElementById('feed-error');
@@ -1350,14 +3779,17 @@ def home_page():
           feedLoading = true;
           feedSpinner.style.display = 'flex';
           feedError.style.display = 'none';
-          if (reset) { feedList.innerHTML = ''; feedOffset = 0; feedEnd = false; }
+          if (reset) { feedList.innerHTML = ''; feedOffset = 0; feedCursor = null; feedEnd = false; }
           try {
-            const res = await fetch(`/api/feed?offset=${feedOffset}&limit=${FEED_BATCH}`);
-            let items = await res.json();
-            if (res.status !== 200) throw new Error(items.error || 'Failed to load');
-            // Shuffle for randomness
-            for (let i = items.length - 1; i > 0; i--) { const j = Math.floor(Math.random() * (i + 1)); [items[i], items[j]] = [items[j], items[i]]; }
-            if (items.length < FEED_BATCH) feedEnd = true;
+            // The server returns a stable shuffled order; pass its cursor back for the next page
+            let url = `/api/feed?limit=${FEED_BATCH}`;
+            if (feedCursor) url += `&cursor=${encodeURIComponent(feedCursor)}`;
+            const res = await fetch(url);
+            const data = await res.json();
+            if (res.status !== 200) throw new Error(data.error || 'Failed to load');
+            const items = data.items;
+            feedCursor = data.cursor;
+            if (!feedCursor) feedEnd = true;
             items.forEach(item => feedList.appendChild(renderFeedCard(item)));
             feedOffset += items.length;
             // If still not filled, load more
@@ -1376,6 +3808,30 @@ def home_page():
           feedSpinner.style.display = 'none';
           feedLoading = false;
         }
+        function paintPlaceholder(img, lqip) {
+          // Blurred tiny copy shown until the real image has loaded
+          if (!lqip) return;
+          img.style.background = `center / cover no-repeat url(${lqip})`;
+          img.addEventListener('load', () => { img.style.background = ''; }, {once: true});
+        }
+        function attachHoverPreview(wrapper, previewUrl) {
+          // Play the short muted preview clip over the thumbnail while hovered
+          let clip = null;
+          wrapper.addEventListener('mouseenter', () => {
+            clip = document.createElement('video');
+            clip.className = 'hover-preview';
+            clip.src = previewUrl;
+            clip.muted = true;
+            clip.loop = true;
+            clip.autoplay = true;
+            clip.playsInline = true;
+            wrapper.appendChild(clip);
+          });
+          wrapper.addEventListener('mouseleave', () => {
+            if (clip) clip.remove();
+            clip = null;
+          });
+        }
         function renderFeedCard(item) {
           if (item.type !== 'image' && item.type !== 'video') return document.createElement('div');
           const div = document.createElement('div');
@@ -1391,6 +3847,16 @@ def home_page():
           // Media
       if (item.type === 'image') {
         const img = document.createElement('img');
+        if (item.srcset) {
+          img.srcset = item.srcset;
+          img.sizes = '(max-width: 520px) 100vw, 480px';
+        }
+        if (item.width && item.height) {
+          // Reserve the image's box so the feed doesn't jump as it loads
+          img.width = item.width;
+          img.height = item.height;
+        }
+        paintPlaceholder(img, item.lqip);
         img.src = item.url;
             img.loading = 'lazy';
             img.onclick = () => showMediaModal({...item, media_key});
@@ -1399,6 +3865,7 @@ def home_page():
         const wrapper = document.createElement('div');
             wrapper.className = 'video-thumb-wrapper';
         const img = document.createElement('img');
+        paintPlaceholder(img, item.lqip);
         img.src = item.thumb || item.url;
             img.alt = 'Video thumbnail';
             img.loading = 'lazy';
@@ -1408,6 +3875,7 @@ def home_page():
         overlay.innerHTML = '►';
         wrapper.appendChild(img);
         wrapper.appendChild(overlay);
+        if (item.preview_url) attachHoverPreview(wrapper, item.preview_url);
             div.appendChild(wrapper);
           }
           // Actions (like, dislike, comment)
@@ -1553,7 +4021,9 @@ def home_page():
             document.addEventListener('themechange', function() { setModalImageTheme(img); });
             mediaCol.appendChild(img);
           } else if (item.type === 'video') {
-            mediaCol.innerHTML = `<video src='${item.url}' class='modal-preview-video' controls autoplay></video>`;
+            // Only Safari plays HLS natively; other browsers get the progressive file
+            const hls = item.stream_url && document.createElement('video').canPlayType('application/vnd.apple.mpegurl');
+            mediaCol.innerHTML = `<video src='${hls ? item.stream_url : (item.playable_url || item.url)}' class='modal-preview-video' controls autoplay></video>`;
           }
           content.appendChild(mediaCol);
           // Side column (actions + comments)
@@ -1904,14 +4374,17 @@ def home_page():
           feedLoading = true;
           feedSpinner.style.display = 'flex';
           feedError.style.display = 'none';
-          if (reset) { feedList.innerHTML = ''; feedOffset = 0; feedEnd = false; }
+          if (reset) { feedList.innerHTML = ''; feedOffset = 0; feedCursor = null; feedEnd = false; }
           try {
-            const res = await fetch(`/api/feed?offset=${feedOffset}&limit=${FEED_BATCH}`);
-            let items = await res.json();
-            if (res.status !== 200) throw new Error(items.error || 'Failed to load');
-            // Shuffle for randomness
-            for (let i = items.length - 1; i > 0; i--) { const j = Math.floor(Math.random() * (i + 1)); [items[i], items[j]] = [items[j], items[i]]; }
-            if (items.length < FEED_BATCH) feedEnd = true;
+            // The server returns a stable shuffled order; pass its cursor back for the next page
+            let url = `/api/feed?limit=${FEED_BATCH}`;
+            if (feedCursor) url += `&cursor=${encodeURIComponent(feedCursor)}`;
+            const res = await fetch(url);
+            const data = await res.json();
+            if (res.status !== 200) throw new Error(data.error || 'Failed to load');
+            const items = data.items;
+            feedCursor = data.cursor;
+            if (!feedCursor) feedEnd = true;
             items.forEach(item => feedList.appendChild(renderFeedCard(item)));
             feedOffset += items.length;
             // If still not filled, load more
@@ -2448,9 +4921,11 @@ def profile_page(username):
         .album-card { background: #3a3b3c; border-radius: 8px; padding: 12px; min-width: 120px; max-width: 160px; cursor: pointer; margin: 8px; display: inline-block; position: relative; transition: all 0.2s ease; }
         .album-card:hover { background: #4a4b4c; transform: translateY(-2px); box-shadow: 0 4px 12px rgba(45,136,255,0.2); }
         .album-card h4 { margin: 0 0 8px 0; font-size: 1em; color: #2d88ff; }
+        .album-card .album-cover { display: block; width: 100%; height: 100px; object-fit: cover; border-radius: 6px; margin-bottom: 8px; }
         .album-upload-btn { position: absolute; top: 5px; right: 5px; background: #28a745; color: #fff; border: none; border-radius: 50%; width: 25px; height: 25px; font-size: 12px; cursor: pointer; display: none; z-index: 10; transition: all 0.2s ease; }
         .album-upload-btn:hover { background: #218838; transform: scale(1.1); }
         .play-overlay { position: absolute; top: 50%; left: 50%; transform: translate(-50%,-50%); background: rgba(0,0,0,0.6); color: #fff; font-size: 2em; border-radius: 50%; padding: 8px 16px; pointer-events: none; }
+        .hover-preview { position: absolute; inset: 0; width: 100%; height: 100%; object-fit: cover; border-radius: inherit; pointer-events: none; }
         .modal { position: fixed; top: 0; left: 0; width: 100vw; height: 100vh; background: rgba(0,0,0,0.82); display: flex; align-items: center; justify-content: center; z-index: 9999; }
         .modal-content {
           background: #23272b;
@@ -2938,7 +5413,9 @@ def profile_page(username):
             document.addEventListener('themechange', function() { setModalImageTheme(img); });
             mediaCol.appendChild(img);
           } else if (item.type === 'video') {
-            mediaCol.innerHTML = `<video src='${item.url}' class='modal-preview-video' controls autoplay></video>`;
+            // Only Safari plays HLS natively; other browsers get the progressive file
+            const hls = item.stream_url && document.createElement('video').canPlayType('application/vnd.apple.mpegurl');
+            mediaCol.innerHTML = `<video src='${hls ? item.stream_url : (item.playable_url || item.url)}' class='modal-preview-video' controls autoplay></video>`;
           }
           content.appendChild(mediaCol);
           const sideCol = document.createElement('div');
@@ -3119,6 +5596,30 @@ def profile_page(username):
           else
             parentCol.replaceChild(commentsDiv, parentCol.querySelector('.modal-comments-section'));
         }
+        function paintPlaceholder(img, lqip) {
+          // Blurred tiny copy shown until the real image has loaded
+          if (!lqip) return;
+          img.style.background = `center / cover no-repeat url(${lqip})`;
+          img.addEventListener('load', () => { img.style.background = ''; }, {once: true});
+        }
+        function attachHoverPreview(wrapper, previewUrl) {
+          // Play the short muted preview clip over the thumbnail while hovered
+          let clip = null;
+          wrapper.addEventListener('mouseenter', () => {
+            clip = document.createElement('video');
+            clip.className = 'hover-preview';
+            clip.src = previewUrl;
+            clip.muted = true;
+            clip.loop = true;
+            clip.autoplay = true;
+            clip.playsInline = true;
+            wrapper.appendChild(clip);
+          });
+          wrapper.addEventListener('mouseleave', () => {
+            if (clip) clip.remove();
+            clip = null;
+          });
+        }
         function openMediaModalWithKey(item) {
           let media_key = item && item.url ? item.url.replace(/^\/files\//, '') : undefined;
           showMediaModal({...item, media_key});
@@ -4760,7 +7261,7 @@ def profile_page(username):
               const card = document.createElement('div');
               card.className = 'album-card';
               card.style.position = 'relative';
-              card.innerHTML = `<h4>${album.name}</h4>`;
+              card.innerHTML = (album.album_thumb ? `<img class="album-cover" src="${album.album_thumb}" loading="lazy" alt="">` : '') + `<h4>${album.name}</h4>`;
               
               // Add delete button to album card
               const deleteBtn = document.createElement('button');
@@ -4838,6 +7339,11 @@ def profile_page(username):
               container.style.position = 'relative';
               
               const img = document.createElement('img');
+              if (item.srcset) {
+                img.srcset = item.srcset;
+                img.sizes = '(max-width: 700px) 33vw, 220px';
+              }
+              paintPlaceholder(img, item.lqip);
               img.src = item.url;
               img.loading = 'lazy';
               img.style.cursor = 'pointer';
@@ -4875,6 +7381,7 @@ def profile_page(username):
               wrapper.style.position = 'relative';
               
               const img = document.createElement('img');
+              paintPlaceholder(img, item.lqip);
               img.src = item.thumb || item.url;
               img.alt = 'Video thumbnail';
               img.loading = 'lazy';
@@ -4884,6 +7391,7 @@ def profile_page(username):
               const overlay = document.createElement('div');
               overlay.className = 'play-overlay';
               overlay.innerHTML = '►';
+              if (item.preview_url) attachHoverPreview(wrapper, item.preview_url);
               
               // Add delete button
               const deleteBtn = document.createElement('button');
@@ -6422,5 +8930,171 @@ def api_story_connection(username, tab):
     save_story_json(tab_dir, story)
     return jsonify({'success': True, 'connections': story['connections']})
 
+# --- Offline prewarming ---
+# `python app.py prewarm` generates every missing video thumbnail and image
+# derivative before the app takes traffic, using a process pool sized to the
+# machine. Results are recorded in the jobs table and the catalog, so an
+# interrupted run resumes where it left off and known-broken files are skipped
+# until they change.
+PREWARM_KINDS = {'thumbnail': 'video thumbnails', 'derivatives': 'image derivatives'}
+
+def _prewarm_one(task):
+    """Process-pool worker: returns ((kind, path), (source, result), error or None)."""
+    kind, local_path, duration, content_hash, size, mtime = task
+    task = (kind, local_path)
+    try:
+        full_path = os.path.join(BASE_DIR, local_path)
+        st = os.stat(full_path)
+        # Hashing is the slow part for big videos, so a catalogued hash is reused
+        if content_hash and (st.st_size, st.st_mtime) == (size, mtime):
+            source = (content_hash, st)
+        else:
+            source = hash_media_file(full_path)
+        if kind == 'thumbnail':
+            return task, (source, extract_video_thumbnail(local_path, source, THUMB_JOB_TIMEOUT, duration)), None
+        return task, (source, build_image_derivatives(local_path, source, THUMB_JOB_TIMEOUT)), None
+    except subprocess.CalledProcessError as e:
+        return task, None, (e.stderr or b'').decode('utf-8', 'replace').strip()[-1000:] or str(e)
+    except Exception as e:
+        return task, None, str(e)
+
+def _prewarm_tasks(db, retry_failed):
+    """Yield (kind, path, mtime, duration, content hash, size) for every output that is missing and worth trying."""
+    backing_off = set()
+    if not retry_failed:
+        now = time.time()
+        for row in db.execute("SELECT kind, path, source_mtime, next_retry FROM jobs WHERE status = 'failed'"):
+            if row['next_retry'] is None or row['next_retry'] > now:
+                backing_off.add((row['kind'], row['path'], row['source_mtime']))
+    rows = db.execute("""SELECT path, type, mtime, size, duration, probed_mtime, probed_size, content_hash FROM media
+                         WHERE (type = 'video' AND thumb IS NULL) OR (type = 'image' AND derivatives IS NULL)
+                         ORDER BY path""").fetchall()
+    for row in rows:
+        kind = 'thumbnail' if row['type'] == 'video' else 'derivatives'
+        if kind == 'derivatives' and not can_derive_image(row['path']):
+            continue
+        if (kind, row['path'], row['mtime']) in backing_off:
+            continue
+        probed = row['probed_mtime'] == row['mtime'] and row['probed_size'] == row['size']
+        yield (kind, row['path'], row['mtime'], row['duration'] if probed else None,
+               row['content_hash'], row['size'])
+
+def prewarm_main(argv):
+    parser = argparse.ArgumentParser(prog='app.py prewarm',
+                                     description='Generate missing video thumbnails and image derivatives.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be generated')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='also retry files that failed before and have not changed')
+    parser.add_argument('--only', choices=sorted(PREWARM_KINDS), help='generate only one kind')
+    args = parser.parse_args(argv)
+
+    init_db()
+    db = connect_db()
+    # The one catalog pass (init_db leaves it to the server's background leader):
+    # builds an empty catalog or picks up files added while the app was not running
+    reconcile_media_catalog(db)
+    tasks = [t for t in _prewarm_tasks(db, args.retry_failed) if not args.only or t[0] == args.only]
+    for kind, label in PREWARM_KINDS.items():
+        print(f"prewarm: {sum(1 for t in tasks if t[0] == kind)} {label} to generate")
+    if args.dry_run:
+        for kind, rel_path, *rest in tasks:
+            print(f"  {kind}: {rel_path}")
+        return 0
+
+    mtimes = {(kind, rel_path): mtime for kind, rel_path, mtime, *rest in tasks}
+    done = failed = 0
+    started = time.time()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = [pool.submit(_prewarm_one, (kind, rel_path, duration, content_hash, size, mtime))
+                   for kind, rel_path, mtime, duration, content_hash, size in tasks]
+        for future in as_completed(futures):
+            (kind, rel_path), result, error = future.result()
+            mtime = mtimes[(kind, rel_path)]
+            enqueue_job(db, kind, rel_path, mtime)
+            if error is None:
+                done += 1
+                db.execute("UPDATE jobs SET status = 'done', attempts = 0, finished = ? WHERE kind = ? AND path = ?",
+                           (time.time(), kind, rel_path))
+                source, output = result
+                store_content_hash(db, rel_path, source[1], source[0])
+                if kind == 'thumbnail':
+                    store_thumbnail(db, source[0])
+                else:
+                    store_image_derivatives(db, rel_path, mtime, output)
+            else:
+                failed += 1
+                print(f"prewarm: {kind} failed for {rel_path}: {error}")
+                now = time.time()
+                db.execute("""UPDATE jobs SET status = 'failed', error = ?, finished = ?, attempts = attempts + 1,
+                                               next_retry = ? + min(?, ? * (1 << min(attempts, 20)))
+                              WHERE kind = ? AND path = ?""",
+                           (error, now, now, JOB_RETRY_MAX, JOB_RETRY_BASE, kind, rel_path))
+            db.commit()
+            finished = done + failed
+            if finished % 25 == 0 or finished == len(tasks):
+                elapsed = time.time() - started
+                eta = elapsed / finished * (len(tasks) - finished)
+                print(f"prewarm: {finished}/{len(tasks)} ({failed} failed), "
+                      f"{elapsed:.0f}s elapsed, ~{eta:.0f}s left")
+    db.close()
+    print(f"prewarm: finished, {done} generated, {failed} failed")
+    return 1 if failed else 0
+
+# --- File serving benchmark ---
+# `python app.py bench-files <path>` replays a player-like mix of requests (a
+# full GET, then ranged reads at random offsets) for one file against /files
+# and against plain send_from_directory, in-process, and prints the throughput
+# of each. The test client copies every body through Python, so this measures
+# the per-request overhead of the two paths; sendfile gains only show up
+# behind a real server.
+def _bench_route(client, url, size, args):
+    rng = random.Random(0)
+    sent = 0
+    started = time.time()
+    for i in range(args.requests):
+        headers = {}
+        if i % 10:
+            start = rng.randrange(max(1, size - args.range_size))
+            headers['Range'] = f'bytes={start}-{start + args.range_size - 1}'
+        response = client.get(url, headers=headers)
+        sent += len(response.get_data())
+        response.close()
+        if response.status_code not in (200, 206):
+            raise RuntimeError(f'{url} answered {response.status_code}')
+    elapsed = time.time() - started
+    return args.requests / elapsed, sent / elapsed / 1024 ** 2
+
+def bench_files_main(argv):
+    global _db_initialized, _run_background
+    parser = argparse.ArgumentParser(prog='app.py bench-files',
+                                     description='Compare /files with plain send_from_directory for one file.')
+    parser.add_argument('path', help='file to request, relative to the app directory')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route (default: 200)')
+    parser.add_argument('--range-size', type=int, default=1024 * 1024,
+                        help='bytes per ranged request (default: 1 MiB)')
+    args = parser.parse_args(argv)
+    full_path = safe_join(BASE_DIR, args.path)
+    if full_path is None or not os.path.isfile(full_path):
+        print(f"bench-files: no such file: {args.path}")
+        return 2
+    init_db()
+    _db_initialized = True
+    _run_background = False  # no watcher or job workers for a benchmark
+    app.add_url_rule('/bench-plain/<path:filename>', 'bench_plain',
+                     lambda filename: send_from_directory(BASE_DIR, filename))
+    client = app.test_client()
+    size = os.path.getsize(full_path)
+    print(f"bench-files: {args.path}, {size} bytes, {args.requests} requests per route")
+    for label, url in (('send_from_directory', f'/bench-plain/{args.path}'), ('/files', f'/files/{args.path}')):
+        rate, throughput = _bench_route(client, url, size, args)
+        print(f"  {label:>20}: {rate:8.1f} req/s {throughput:8.1f} MiB/s")
+    return 0
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'prewarm':
+        sys.exit(prewarm_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-files':
+        sys.exit(bench_files_main(sys.argv[2:]))
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""
+/files with MEDIA_OFFLOAD: the app only names the file (X-Accel-Redirect or
+X-Sendfile) and a front proxy streams it. A small WSGI stand-in for that proxy
+checks clients get the same bytes as when the app serves the file itself, and
+that nothing outside the media folders can be named.
+"""
+import hashlib
+import importlib.util
+import os
+import random
+import shutil
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+import pytest
+from werkzeug.test import Client
+
+APP_SOURCE = Path(__file__).resolve().parents[1] / 'app.py'
+
+MEDIA_FILES = {
+    'users/alice/pics/p1.jpg': 40_000,
+    'users/alice/trip/day 1/t #1?.jpg': 1_000,
+    'videos/clip.mp4': 700_000,  # several MEDIA_BUFFER_SIZE reads
+    'interfaith/i.png': 5_000,
+    'gallery/a/b/g.mp4': 0,
+}
+
+
+def _content(rel_path, size):
+    rng = random.Random(rel_path)
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+@pytest.fixture(scope='module')
+def media_app(tmp_path_factory):
+    """
+    app.py loaded from a scratch copy, so BASE_DIR and its database are
+    temporary, and the files it can serve: (module, {rel_path: size}).
+    """
+    base = tmp_path_factory.mktemp('site')
+    shutil.copy(APP_SOURCE, base / 'app.py')
+    files = dict(MEDIA_FILES)
+    for rel_path, size in files.items():
+        (base / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (base / rel_path).write_bytes(_content(rel_path, size))
+    outside = tmp_path_factory.mktemp('outside') / 'secret.jpg'
+    outside.write_bytes(b'not media')
+    # Symlinks inside a media folder that lead out of it
+    (base / 'users/alice/pics/secret.jpg').symlink_to(outside)
+    (base / 'users/alice/pics/app.jpg').symlink_to(base / 'app.py')
+    (base / 'videos/db.mp4').symlink_to(base / 'appdata.sqlite3')
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('CATALOG_WATCHER', 'off')
+        mp.setenv('JOB_WORKERS', '0')
+        mp.setenv('MEDIA_OFFLOAD', 'off')
+        spec = importlib.util.spec_from_file_location('offload_app', base / 'app.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    module.app.config['TESTING'] = True
+    # A derivative in the store, served as immutable
+    thumb = module.thumb_path_for(hashlib.sha256(b'clip').hexdigest())
+    (base / thumb).parent.mkdir(parents=True)
+    (base / thumb).write_bytes(_content(thumb, 3_000))
+    files[thumb] = 3_000
+    # Creates the database the symlink above points at
+    Client(module.app).get('/files/videos/clip.mp4')
+    return module, files
+
+
+def offload_proxy(media_app):
+    """
+    WSGI stand-in for nginx (internal location aliased to BASE_DIR) or an
+    X-Sendfile server in front of the app: it follows the header and streams
+    the named file itself, keeping the app's other headers.
+    """
+    def proxy(environ, start_response):
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured['status'], captured['headers'] = status, headers
+
+        app_iter = media_app.app(environ, capture)
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        headers = [(k, v) for k, v in captured['headers'] if k not in ('X-Accel-Redirect', 'X-Sendfile')]
+        found = dict(captured['headers'])
+        if 'X-Accel-Redirect' in found:
+            # A URI, like nginx reads it: '?' and '#' in a name only survive if escaped
+            uri = unquote(urlsplit(found['X-Accel-Redirect']).path)
+            assert uri.startswith(media_app.MEDIA_OFFLOAD_PREFIX)
+            assert body == b''
+            full_path = os.path.join(media_app.BASE_DIR, uri[len(media_app.MEDIA_OFFLOAD_PREFIX):])
+        elif 'X-Sendfile' in found:
+            full_path = found['X-Sendfile']
+            assert os.path.isabs(full_path)
+            assert body == b''
+        else:
+            start_response(captured['status'], headers)
+            return [body]
+        with open(full_path, 'rb') as f:
+            body = f.read()
+        headers = [(k, v) for k, v in headers if k != 'Content-Length']
+        start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+        return [body]
+    return proxy
+
+
+def _files_url(rel_path):
+    return '/files/' + '/'.join(part.replace('#', '%23').replace('?', '%3F') for part in rel_path.split('/'))
+
+
+@pytest.mark.parametrize('mode, header', [('nginx', 'X-Accel-Redirect'), ('sendfile', 'X-Sendfile')])
+def test_offloaded_body_matches_direct(media_app, monkeypatch, mode, header):
+    media_app, files = media_app
+    for rel_path, size in files.items():
+        monkeypatch.setattr(media_app, 'MEDIA_OFFLOAD', 'off')
+        direct = Client(media_app.app).get(_files_url(rel_path))
+        assert direct.status_code == 200, rel_path
+        assert direct.get_data() == _content(rel_path, size)
+
+        monkeypatch.setattr(media_app, 'MEDIA_OFFLOAD', mode)
+        offloaded = Client(media_app.app).get(_files_url(rel_path))
+        assert offloaded.status_code == 200
+        assert offloaded.headers.get(header)
+        assert offloaded.get_data() == b''
+
+        proxied = Client(offload_proxy(media_app)).get(_files_url(rel_path))
+        assert proxied.status_code == 200, rel_path
+        assert proxied.get_data() == direct.get_data()
+        assert proxied.headers['Content-Type'] == direct.headers['Content-Type']
+        assert proxied.headers['Cache-Control'] == direct.headers['Cache-Control']
+
+
+@pytest.mark.parametrize('mode', ['off', 'nginx', 'sendfile'])
+@pytest.mark.parametrize('rel_path', [
+    'appdata.sqlite3',
+    'app.py',
+    'users/../app.py',
+    'users/alice/../../appdata.sqlite3',
+    '.derivatives/../app.py',
+    'users/alice/pics/secret.jpg',
+    'users/alice/pics/app.jpg',
+    'videos/db.mp4',
+    'users/alice/pics',
+])
+def test_outside_media_is_not_found(media_app, monkeypatch, mode, rel_path):
+    media_app, _ = media_app
+    monkeypatch.setattr(media_app, 'MEDIA_OFFLOAD', mode)
+    response = Client(media_app.app).get('/files/' + rel_path)
+    assert response.status_code == 404
+    assert 'X-Accel-Redirect' not in response.headers
+    assert 'X-Sendfile' not in response.headers
+    assert Client(offload_proxy(media_app)).get('/files/' + rel_path).status_code == 404